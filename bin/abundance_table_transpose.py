@@ -7,7 +7,174 @@ being metagenome IDs, and table data representing abundance
 for each subsystem and metagenome ID.
 """
 import argparse
-from collections import defaultdict
+from array import array
+import os.path as osp
+
+import numpy as np
+
+from mgr_api import table as mgtable
+
+
+class SubsystemAbundance(object):
+    """
+    A metagenome subsystem abundance list with the subsystem levels (1 up to
+    level) and metagenome ID of each row encoded as integer codes, ready to
+    be aggregated into a table at level, or any coarser level, with
+    abundance_table().
+
+    :type in_f: file
+    :param in_f: The open abundance list, positioned after the header.
+    :type header: list
+    :param header: The fields of the abundance list header line.
+    :type level: int
+    :param level: The finest subsystem level (1-4) at which to bin the
+                  abundance.
+    """
+    def __init__(self, in_f, header, level):
+        self.level = level
+        self.has_id = header[5] == 'id'
+        abd_col = 5 if not self.has_id else 6
+        with_id = self.has_id and level == 4
+        max_lvl = level + 1
+
+        mg_idx = {}
+        key_idx = {}
+        key_ids = {}
+        mg_codes = array('i')
+        key_codes = array('i')
+        abundance = array('l')
+        add_mg, add_key = mg_codes.append, key_codes.append
+        add_abundance = abundance.append
+        for n, line in enumerate(in_f):
+            row = line.strip().split('\t')
+            mg = mg_idx.get(row[0])
+            if mg is None:
+                mg = mg_idx[row[0]] = len(mg_idx)
+            add_mg(mg)
+            subsys = tuple(row[1:max_lvl])
+            key = key_idx.get(subsys)
+            if key is None:
+                key = key_idx[subsys] = len(key_idx)
+            add_key(key)
+            add_abundance(int(row[abd_col]))
+            if with_id:
+                key_ids[key] = (n, row[5])
+
+        # metagenome IDs in the order a dict of them iterates (the output
+        # column order)
+        self.mg_ids = list(mg_idx)
+        mg_order = np.empty(len(mg_idx), dtype=np.intc)
+        mg_order[[mg_idx[mg_id] for mg_id in self.mg_ids]] = \
+            np.arange(len(mg_idx))
+        self.mg_codes = mg_order[np.frombuffer(mg_codes, dtype=np.intc)]
+
+        # the distinct (unjoined) subsystem levels of the rows
+        self.keys = sorted(key_idx, key=key_idx.get)
+        self.key_codes = np.frombuffer(key_codes, dtype=np.intc)
+        self.abundance = np.array(abundance, dtype=np.int64)
+        # the (row number, ID) of the last row listing each key
+        self.key_ids = key_ids if with_id else None
+        self._key_table = None
+
+    def key_table(self):
+        """
+        Return the abundance summed for each distinct key (the subsystem
+        levels up to self.level, as listed) and metagenome ID, as a 2D array
+        with a row per key and a column per metagenome ID.
+        """
+        if self._key_table is None:
+            n_mg = len(self.mg_ids)
+            cells = self.key_codes.astype(np.int64) * n_mg
+            cells += self.mg_codes
+            table = np.zeros(len(self.keys) * n_mg, dtype=np.int64)
+            np.add.at(table, cells, self.abundance)
+            self._key_table = table.reshape(len(self.keys), n_mg)
+        return self._key_table
+
+    def subsystems(self, level):
+        """
+        Return the sorted, distinct "@@"-joined subsystems at level, and an
+        array mapping each key to its subsystem.
+        """
+        key_subsys = ['@@'.join([entry.strip('"') for entry in key[:level]])
+                      for key in self.keys]
+        subsystems = sorted(set(key_subsys))
+        subsys_idx = {subsys: i for i, subsys in enumerate(subsystems)}
+        return subsystems, np.array([subsys_idx[subsys]
+                                     for subsys in key_subsys], dtype=np.intc)
+
+
+def abundance_table(subsys_abd, level=None):
+    """
+    Sum the abundance for each subsystem at level (by default, the level the
+    list was parsed at) and metagenome ID, rolling up the finer levels.
+
+    :rtype: tuple
+    :return: The sorted subsystems, a 2D array with a row per subsystem and
+             a column per metagenome ID, and the ID of each subsystem (the
+             last one listed for it) at level 4 if the list has them, or
+             None.
+    """
+    if level is None:
+        level = subsys_abd.level
+    subsystems, key_to_subsys = subsys_abd.subsystems(level)
+    table = np.zeros((len(subsystems), len(subsys_abd.mg_ids)),
+                     dtype=np.int64)
+    np.add.at(table, key_to_subsys, subsys_abd.key_table())
+
+    ids = None
+    if subsys_abd.key_ids is not None and level == 4:
+        last = {}
+        for key, subsys in enumerate(key_to_subsys.tolist()):
+            if subsys_abd.key_ids[key] > last.get(subsys, (-1,)):
+                last[subsys] = subsys_abd.key_ids[key]
+        ids = [last[subsys][1] for subsys in range(len(subsystems))]
+
+    return subsystems, table, ids
+
+
+def write_table(out_f, level, subsystems, mg_ids, table, ids=None):
+    """
+    Write an abundance table (see abundance_table()) in the transposed table
+    format: a column for each subsystem level (and ID, if given) followed by
+    a column of abundance for each metagenome ID.
+    """
+    out_f.write(''.join(['Level {}\t'.format(lvl+1) for lvl in range(level)]) +
+                ('ID\t' if ids is not None else '') +
+                '\t'.join(mg_ids) + '\n')
+
+    for i, subsys in enumerate(subsystems):
+        subsys_lvls = subsys.split('@@')
+        if ids is not None:
+            subsys_lvls[3] += '\t' + ids[i]
+        out_f.write('\t'.join(subsys_lvls[:level]) + '\t' +
+                    '\t'.join(map(str, table[i].tolist())) + '\n')
+
+
+def write_binary_table(out_fp, level, subsystems, mg_ids, table, ids=None):
+    """
+    Write an abundance table (see abundance_table()) as a binary table (see
+    mgr_api.table), with the subsystem levels (and ID, if given) as the key
+    columns.
+    """
+    key_cols = ['Level {}'.format(lvl+1) for lvl in range(level)]
+    if ids is not None:
+        key_cols.append('ID')
+    keys = (subsys.split('@@')[:level] + ([ids[i]] if ids is not None else [])
+            for i, subsys in enumerate(subsystems))
+    mgtable.write_table(mgtable.AbundanceTable.from_rows(key_cols, mg_ids,
+                                                         zip(keys, table)),
+                        out_fp)
+
+
+def level_output_fp(output_fp, level):
+    """
+    Return the output file path for one of several subsystem levels, e.g.
+    table_level2.txt for table.txt
+    """
+    root, ext = osp.splitext(output_fp)
+    return '{}_level{}{}'.format(root, level, ext)
+
 
 def handle_program_options():
     """
@@ -22,11 +189,20 @@ def handle_program_options():
     parser.add_argument('-i', '--input_list_fp', required=True,
                         help="The metagenome subsystem abundance list.")
     parser.add_argument('-o', '--output_fp', required=True,
-                        help="The output file name.")
-    parser.add_argument('-s', '--subsystem_level', default=4, choices=[1, 2, 3, 4],
-                        type=int, help="The maximum metagenomic subsystem \
-                                         level in which to bin the abundance \
-                                         results. Default is 4 (all levels).")
+                        help="The output file name. If more than one subsystem\
+                              level is given, a table is written for each level\
+                              with '_level<N>' added to the file name.")
+    parser.add_argument('-s', '--subsystem_level', default=['4'], nargs='+',
+                        choices=['1', '2', '3', '4', 'all'],
+                        help="The maximum metagenomic subsystem \
+                              level in which to bin the abundance \
+                              results. Default is 4 (all levels). Several\
+                              levels, or 'all' for levels 1-4, can be given\
+                              to write a table for each from a single pass\
+                              over the list.")
+    parser.add_argument('--binary', action='store_true',
+                        help="Write the table(s) as binary tables (see\
+                              mgr_api.table) instead of tab-separated text.")
 
 #    parser.add_argument('-v', '--verbose', action='store_true')
 
@@ -35,49 +211,28 @@ def handle_program_options():
 
 def main():
     args = handle_program_options()
-    mg_abundance = defaultdict(lambda: defaultdict(int))
-    subsystems = set()
-    subsys_to_KO = {}
-    max_lvl = 5-(4-args.subsystem_level)
+    if 'all' in args.subsystem_level:
+        levels = [1, 2, 3, 4]
+    else:
+        levels = sorted(set(int(level) for level in args.subsystem_level))
 
     with open(args.input_list_fp, 'rU') as inF:
         header = inF.readline().split('\t')
-        mg_subsys = [line.strip().split('\t') for line in inF]
-
-    # verify the column containing abundance data
-    abd_col = 5 if header[5] != 'id' else 6
-
-    # collect abundance per functional level and metagenome ID
-    for row in mg_subsys:
-        subsys = '@@'.join([entry.strip('"') for entry in row[1:max_lvl]])
-        if header[5] == 'id' and args.subsystem_level == 4:
-            subsys_to_KO[subsys] = row[5]
-        mg_abundance[row[0]][subsys] += int(row[abd_col])
-        subsystems.add(subsys)
-
-    # write out the data in the transposed table format
-    with open(args.output_fp, 'w') as outF:
-        lvl_str = ['{lvl1}', '{lvl2}', '{lvl3}', '{func}']
-        
-        id_field = ''
-        if header[5] == 'id' and args.subsystem_level == 4:
-            id_field = 'ID\t'
-
-        # write header
-        outF.write(''.join(['Level {}\t'.format(lvl+1) for lvl in range(args.subsystem_level)]) + 
-                   id_field + '\t'.join(mg_abundance.keys()) + '\n')
-
-        out_line = '\t'.join([l for l in lvl_str[:args.subsystem_level]])+'\t{abd}\n'
-        for subsys in sorted(subsystems):
-            abd = []
-            for mgid in mg_abundance:
-                abd.append(0 if subsys not in mg_abundance[mgid] else mg_abundance[mgid][subsys])
-            subsys_lvls = subsys.split('@@')
-            if header[5] == 'id' and args.subsystem_level == 4:
-                subsys_lvls[3] += '\t' + subsys_to_KO[subsys]
-            out_args = {k:l for k, l in zip(['lvl1', 'lvl2', 'lvl3', 'func'][:args.subsystem_level], subsys_lvls)}
-            out_args['abd'] = '\t'.join(map(str, abd))
-            outF.write(out_line.format(**out_args))
+        subsys_abd = SubsystemAbundance(inF, header, max(levels))
+
+    for level in levels:
+        out_fp = (args.output_fp if len(levels) == 1 else
+                  level_output_fp(args.output_fp, level))
+        subsystems, table, ids = abundance_table(subsys_abd, level)
+        if args.binary:
+            write_binary_table(out_fp, level, subsystems, subsys_abd.mg_ids,
+                               table, ids)
+        else:
+            with open(out_fp, 'w') as outF:
+                write_table(outF, level, subsystems, subsys_abd.mg_ids, table,
+                            ids)
+        if len(levels) > 1:
+            print "Level {} table written to: {}".format(level, out_fp)
 
 
 if __name__ == '__main__':
@@ -7,7 +7,234 @@ Author: Shareef M Dabdoub
 '''
 import argparse
 import csv
-import os.path as osp
+import json
+import os, os.path as osp
+import sqlite3
+import sys
+import threading
+
+from mgr_api import table as mgtable
+from mgr_api.util import native_str, replace
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+class DictIndex(object):
+    """
+    An annotation index parsed fully into memory from a tab-separated file
+    whose first column holds the unique IDs.
+    """
+    def __init__(self, index_fp):
+        with open(index_fp, 'rU') as inf:
+            reader = csv.reader(inf, delimiter='\t')
+            self.fieldnames = next(reader)
+            self.index = {row[0]: row for row in reader if row}
+
+    def get(self, ann_id):
+        """
+        Return the index fields (in fieldnames order) for ann_id, or None.
+        """
+        return self.index.get(ann_id)
+
+
+class CompiledIndex(object):
+    """
+    An annotation index compiled into an on-disk SQLite table keyed on the
+    unique ID (see compile_index()). Opening it does not read the index;
+    each lookup fetches only the requested row. Lookups may be made from
+    several threads at once.
+    """
+    def __init__(self, db_fp):
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(db_fp, check_same_thread=False)
+        self.db.text_factory = str
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        self.fieldnames = [native_str(name) for name in
+                           json.loads(meta['fieldnames'])]
+        self.source_mtime = float(meta['source_mtime'])
+        self.source_size = int(meta['source_size'])
+
+    def get(self, ann_id):
+        """
+        Return the index fields (in fieldnames order) for ann_id, or None.
+        """
+        with self._lock:
+            row = self.db.execute('SELECT fields FROM annotation WHERE id = ?',
+                                  (ann_id,)).fetchone()
+        if row is None:
+            return None
+        return [native_str(field) for field in json.loads(row[0])]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def compile_index(index_fp, db_fp):
+    """
+    Compile a tab-separated index file (unique IDs in the first column) into
+    an SQLite database keyed on ID, for fast reuse by later runs.
+    """
+    tmp_fp = db_fp + '.tmp'
+    if osp.isfile(tmp_fp):
+        os.remove(tmp_fp)
+    db = sqlite3.connect(tmp_fp)
+    db.text_factory = str
+    stat = os.stat(index_fp)
+    with open(index_fp, 'rU') as inf:
+        reader = csv.reader(inf, delimiter='\t')
+        fieldnames = next(reader)
+        db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        db.executemany('INSERT INTO meta VALUES (?, ?)',
+                       [('fieldnames', json.dumps(fieldnames)),
+                        ('source_mtime', repr(stat.st_mtime)),
+                        ('source_size', str(stat.st_size))])
+        db.execute('CREATE TABLE annotation (id TEXT PRIMARY KEY, fields TEXT)')
+        db.executemany('INSERT OR REPLACE INTO annotation VALUES (?, ?)',
+                       ((row[0], json.dumps(row)) for row in reader if row))
+    db.commit()
+    db.close()
+    replace(tmp_fp, db_fp)
+
+
+def is_compiled_index(fp):
+    with open(fp, 'rb') as inf:
+        return inf.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def open_index(index_fp, compiled=False):
+    """
+    Open an annotation index. index_fp may be a tab-separated index file or
+    an index compiled with compile_index(). If compiled is True, a
+    tab-separated index is compiled to index_fp + '.db' (unless an up to
+    date compiled copy already exists there) and that copy is opened.
+    """
+    if is_compiled_index(index_fp):
+        return CompiledIndex(index_fp)
+    if not compiled:
+        return DictIndex(index_fp)
+
+    db_fp = index_fp + '.db'
+    if osp.isfile(db_fp):
+        index = CompiledIndex(db_fp)
+        stat = os.stat(index_fp)
+        if (index.source_mtime == stat.st_mtime and
+                index.source_size == stat.st_size):
+            return index
+        index.close()
+    compile_index(index_fp, db_fp)
+    return CompiledIndex(db_fp)
+
+class MissingIDs(object):
+    """
+    The number of IDs not found in the index, and the first sample_size of
+    them for reporting, so that memory use does not grow with the number
+    of misses.
+    """
+    def __init__(self, sample_size=20):
+        self.count = 0
+        self.sample = []
+        self.sample_size = sample_size
+
+    def __len__(self):
+        return self.count
+
+    def add(self, ann_id):
+        self.count += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(ann_id)
+
+
+def annotate_rows(index, ann_fields, rows, missing):
+    """
+    Annotate the rows of a file with the columns ann_fields (unique IDs in
+    the first column) from index. Where a column of the file shares its name
+    with an index column, the index value is used, as for the index columns
+    themselves. IDs not found in the index are added to missing (a
+    MissingIDs).
+
+    :return: The output header and an iterator over the annotated rows.
+    """
+    n_fields = len(index.fieldnames)
+    out_header = index.fieldnames + ann_fields[1:]
+    # each output column as an offset into the index fields followed by
+    # the annotation row (later duplicate names win, as with a dict)
+    index_pos = {name: i for i, name in enumerate(index.fieldnames)}
+    ann_pos = {name: n_fields + i for i, name in enumerate(ann_fields)}
+    columns = [index_pos[name] if name in index_pos else ann_pos[name]
+               for name in out_header]
+    blank = [''] * n_fields
+
+    def annotated():
+        for row in rows:
+            ann_id = row[0]
+            annotation = index.get(ann_id)
+            if annotation is None:
+                missing.add(ann_id)
+                annotation = [ann_id] + blank[1:]
+            elif len(annotation) < n_fields:
+                annotation = annotation + blank[len(annotation):]
+            if len(row) < len(ann_fields):
+                row = row + [''] * (len(ann_fields) - len(row))
+            fields = annotation[:n_fields] + row
+            yield [fields[c] for c in columns]
+
+    return out_header, annotated()
+
+
+def write_rows(out_fp, header, rows):
+    """
+    Write rows to the tab-separated out_fp as they are produced, returning
+    the number of rows written.
+    """
+    n_rows = 0
+    with open(out_fp, 'w') as outf:
+        outf.write('\t'.join(header) + '\n')
+        for row in rows:
+            outf.write('\t'.join(row) + '\n')
+            n_rows += 1
+    return n_rows
+
+
+def annotate_file(index, ann_fp, out_fp, binary=False):
+    """
+    Annotate ann_fp, a comma-separated file or a binary table (see
+    mgr_api.table) with unique IDs in the first column, from index,
+    streaming each annotated row to the tab-separated out_fp. If binary,
+    ann_fp must be a binary table and out_fp is written as a binary table
+    with the index fields added to its key columns.
+
+    :return: The number of rows written and the MissingIDs not found in the
+             index.
+    """
+    missing = MissingIDs()
+    if mgtable.is_table(ann_fp):
+        abd_table = mgtable.read_table(ann_fp)
+        out_header, rows = annotate_rows(index, abd_table.key_columns +
+                                         abd_table.samples,
+                                         abd_table.rows(), missing)
+        if not binary:
+            return write_rows(out_fp, out_header, rows), missing
+
+        n_keys = len(out_header) - len(abd_table.samples)
+        out_table = mgtable.AbundanceTable.from_rows(out_header[:n_keys],
+                                                     out_header[n_keys:],
+                                                     ((row[:n_keys],
+                                                       row[n_keys:])
+                                                      for row in rows))
+        mgtable.write_table(out_table, out_fp)
+        return len(out_table), missing
+
+    with open(ann_fp, 'rU') as ann_f:
+        reader = csv.reader(ann_f, delimiter=',')
+        out_header, rows = annotate_rows(index, next(reader), reader, missing)
+        return write_rows(out_fp, out_header, rows), missing
+
+
+def output_path(ann_fp, binary=False):
+    return (osp.splitext(ann_fp.rstrip(os.sep))[0] +
+            ("_ann" if binary else "_ann.txt"))
+
 
 def handle_program_options():
     parser = argparse.ArgumentParser(description="Annotate a file containing\
@@ -16,14 +243,29 @@ def handle_program_options():
     parser.add_argument('-i', '--index_fp', required=True,
                         help="Path to the file containing the ID-based\
                         annotations. NOTE: This file must contain the unique ID\
-                        for each entry as the first column.")
-    parser.add_argument('-a', '--annotate_fp', required=True,
-                        help="Path to the file to be annotated.")
+                        for each entry as the first column. This may also be\
+                        an index compiled with --compile_index.")
+    parser.add_argument('-c', '--compile_index', action='store_true',
+                        help="Compile the index file into an on-disk database\
+                        (saved as the index file name with '.db' appended)\
+                        the first time it is used, and reuse it on later runs\
+                        as long as the index file is unchanged. Only the\
+                        annotations needed are then read from the index.")
+    parser.add_argument('-a', '--annotate_fp', required=True, nargs='+',
+                        help="Path to the file(s) to be annotated. Multiple\
+                        files are annotated in turn against a single copy of\
+                        the index. Each may be comma-separated or a binary\
+                        table (see mgr_api.table).")
     parser.add_argument('-o', '--output_fp',
                         help="Path to the (tab-separated) annotated results\
                         file. By default, the output file will be written to\
                         the same directory as the input file with '_ann'\
-                        appended to the file name.")
+                        appended to the file name. Only valid with a single\
+                        input file.")
+    parser.add_argument('--binary', action='store_true',
+                        help="Write the annotated results as binary tables\
+                        (see mgr_api.table). The files to be annotated must\
+                        also be binary tables.")
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Prints status messages during program execution.")
 
@@ -33,48 +275,37 @@ def handle_program_options():
 def main():
     args = handle_program_options()
 
-    # parse index file
-    with open(args.index_fp, 'rU') as inf:
-        index_DR = csv.DictReader(inf, delimiter='\t')
-        id_column = index_DR.fieldnames[0]
-        index = {line[id_column]: line for line in index_DR}
+    if args.output_fp and len(args.annotate_fp) > 1:
+        sys.exit("ERROR: --output_fp can only be used with a single input "
+                 "file.")
 
-    # create output file path
-    if not args.output_fp:
-        deseq_fp_split = osp.splitext(args.annotate_fp)
-        out_fp = deseq_fp_split[0] + "_ann.txt"
-    else:
-        out_fp = args.output_fp
-
-
-    # parse the file to be annotated
-    with open(args.annotate_fp, 'rU') as deseq_f:
-        ann_DR = csv.DictReader(deseq_f, delimiter=',')
-        ann_id_column = ann_DR.fieldnames[0]
-        ann_res = [line for line in ann_DR]
-
-    # update the results data with annotations
-    for entry in ann_res:
-        ann_id = entry[ann_id_column]
-        if ann_id in index:
-            entry.update(index[ann_id])
-        else:
-            print "ID '{}'' not found, skipping.".format(ann_id)
-            blank_annotation = {field: '' for field in index_DR.fieldnames[0]}
-            blank_annotation[id_column] = ann_id
-            entry.update(blank_annotation)
-
-    # output the annotated results
-    out_header = index_DR.fieldnames + ann_DR.fieldnames[1:]
-    out_line = "\t".join(['{'+item+'}' for item in out_header]) + '\n'
+    if args.binary and not all(mgtable.is_table(ann_fp)
+                               for ann_fp in args.annotate_fp):
+        sys.exit("ERROR: --binary requires the files to be annotated to be "
+                 "binary tables.")
 
-    with open(out_fp, 'w') as outf:
-        outf.write('\t'.join(out_header) + '\n')
-        for entry in ann_res:
-            outf.write(out_line.format(**entry))
+    # parse or open the index file
+    index = open_index(args.index_fp, args.compile_index)
+
+    # create output file paths
+    if args.output_fp:
+        out_fps = [args.output_fp]
+    else:
+        out_fps = [output_path(ann_fp, args.binary)
+                   for ann_fp in args.annotate_fp]
 
-    print "Annotated results written to: {}".format(out_fp)
+    # annotate the files against the shared index
+    for ann_fp, out_fp in zip(args.annotate_fp, out_fps):
+        n_rows, missing = annotate_file(index, ann_fp, out_fp, args.binary)
+        if missing:
+            print "{}: {} of {} IDs not found in the index, left unannotated.".format(ann_fp, len(missing), n_rows)
+            if args.verbose:
+                shown = ', '.join(missing.sample)
+                if len(missing) > len(missing.sample):
+                    shown += ' and {} more'.format(len(missing) - len(missing.sample))
+                print "Missing IDs: {}".format(shown)
+        print "Annotated results written to: {}".format(out_fp)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
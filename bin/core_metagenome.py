@@ -8,7 +8,194 @@ Author: Shareef M Dabdoub
 '''
 import argparse
 import csv
-import os.path as osp
+from itertools import islice
+import os, os.path as osp
+import sys
+import tempfile
+
+import numpy as np
+
+from mgr_api import table as mgtable
+
+
+def parse_abundance(in_f):
+    """
+    Read a tab-separated abundance table, returning the header and a list of
+    the data rows (each a list of strings). Blank lines are skipped.
+    """
+    reader = csv.reader(in_f, delimiter="\t")
+    header = next(reader)
+    return header, [row for row in reader if row]
+
+
+def _fill_empty(text):
+    # write a '0' into every empty cell of tab-separated lines
+    text = '\t' + text.rstrip('\n').replace('\n', '\t\n\t') + '\t'
+    text = text.replace('\t\t', '\t0\t').replace('\t\t', '\t0\t')
+    return text.replace('\t\n\t', '\n')[1:-1]
+
+
+def _float(cell):
+    try:
+        return float(cell)
+    except ValueError:
+        return 0.0
+
+
+def presence_counts(lines, sample_start, n_samples):
+    """
+    Count the number of samples in which the gene of each line of an
+    abundance table is present, i.e. has a non-zero abundance, so values
+    such as '0.0' are correctly counted as absent. Empty or missing cells
+    count as absent, as do cells that are not numbers (e.g. 'NA').
+
+    The sample columns of all the lines are parsed by NumPy in a single
+    call; only lines with quoted fields or cells NumPy cannot parse fall
+    back to the csv module and parsing one cell at a time.
+
+    :rtype: tuple
+    :return: The gene ID (the column before sample_start) of each line, and
+             a numpy.ndarray of the number of samples with the gene present.
+    """
+    id_idx = sample_start - 1
+    matrix = None
+    text = ''.join(lines)
+    if '"' not in text:
+        try:
+            matrix = np.loadtxt(_fill_empty(text).split('\n'),
+                                delimiter='\t', comments=None, ndmin=2,
+                                usecols=range(sample_start,
+                                              sample_start + n_samples))
+            ids = [line.split('\t', sample_start)[id_idx] for line in lines]
+        except (ValueError, IndexError):
+            matrix = None
+
+    if matrix is None:
+        rows = list(csv.reader(lines, delimiter="\t"))
+        ids = [row[id_idx] for row in rows]
+        padding = [''] * n_samples
+        cells = [(row[sample_start:] + padding)[:n_samples] for row in rows]
+        matrix = np.array([[_float(cell) for cell in row] for row in cells],
+                          dtype=np.float64).reshape(len(rows), n_samples)
+    matrix[np.isnan(matrix)] = 0
+    return ids, np.count_nonzero(matrix, axis=1)
+
+
+def table_presence_counts(values, chunk_size=10000):
+    """
+    Count the number of samples in which each row's gene is present from a
+    2D array of abundances (e.g. a memory-mapped binary table), chunk_size
+    rows at a time.
+    """
+    counts = np.empty(len(values), dtype=np.int64)
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        counts[start:start + len(chunk)] = np.count_nonzero(chunk, axis=1)
+    return counts
+
+
+def _spool(lines, spill_f):
+    for line in lines:
+        spill_f.write(line)
+        yield line
+
+
+def stream_presence_counts(in_f, sample_start, spill_f=None,
+                           chunk_size=10000):
+    """
+    Read an abundance table chunk_size lines at a time and keep only the
+    number of samples each gene is present in (see presence_counts()), so
+    that memory use is bounded by the number of genes rather than the size
+    of the table. If spill_f is given, every input line is also copied to it
+    so that a non-seekable input (e.g. stdin) can be read a second time.
+
+    :rtype: tuple
+    :return: The header, a dict of presence counts keyed by gene ID and the
+             number of data rows read.
+    """
+    lines = iter(in_f if spill_f is None else _spool(in_f, spill_f))
+    header = next(csv.reader([next(lines)], delimiter="\t"))
+    lines = (line for line in lines if line.strip())
+    n_samples = len(header) - sample_start
+    gene_counts = {}
+    n_rows = 0
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            break
+        ids, counts = presence_counts(chunk, sample_start, n_samples)
+        gene_counts.update(zip(ids, counts.tolist()))
+        n_rows += len(chunk)
+    return header, gene_counts, n_rows
+
+
+def core_size_curve(gene_counts, n_samples, percents):
+    """
+    Given the number of samples each gene is present in, compute the size of
+    the core metagenome for a range of minimum-percent thresholds at once.
+
+    :rtype: list
+    :return: (percent, minimum number of samples, number of core genes) for
+             each threshold percent.
+    """
+    hist = np.bincount(np.asarray(gene_counts, dtype=np.int64),
+                       minlength=n_samples + 1)
+    # at_least[k]: the number of genes present in k or more samples
+    at_least = np.append(np.cumsum(hist[::-1])[::-1], 0)
+    curve = []
+    for pct in percents:
+        # the same rounding down as used by -p
+        min_core_amt = int(n_samples * pct)
+        idx = min(max(min_core_amt, 0), len(at_least) - 1)
+        curve.append((pct, min_core_amt, int(at_least[idx])))
+    return curve
+
+
+def sweep_percents(start, stop, step):
+    """
+    Return the threshold percents from start to stop (inclusive) by step,
+    rounded to remove floating point noise so that each matches the value
+    that would be given to -p.
+    """
+    n_steps = int(round((stop - start) / step)) + 1
+    return [round(start + i * step, 10) for i in range(n_steps)]
+
+
+def write_cores(outputs, header, rows, id_idx):
+    """
+    Write the rows of the abundance table whose gene ID is in a core set,
+    for one or more (output path, core set) pairs, in a single pass over
+    rows.
+    """
+    out_fs = [open(out_fp, 'w') for out_fp, _ in outputs]
+    try:
+        writers = [(csv.writer(out_f, delimiter="\t"), core)
+                   for out_f, (_, core) in zip(out_fs, outputs)]
+        for writer, _ in writers:
+            writer.writerow(header)
+        for row in rows:
+            for writer, core in writers:
+                if row[id_idx] in core:
+                    writer.writerow(row)
+    finally:
+        for out_f in out_fs:
+            out_f.close()
+
+
+def write_core_table(out_fp, core, header, rows, id_idx, sample_start):
+    """
+    Write the rows of the abundance table whose gene ID is in core as a
+    binary table (see mgr_api.table).
+    """
+    n_samples = len(header) - sample_start
+    core_rows = ((row[:sample_start],
+                  (row[sample_start:] + [''] * n_samples)[:n_samples])
+                 for row in rows if row[id_idx] in core)
+    mgtable.write_table(mgtable.AbundanceTable.from_rows(header[:sample_start],
+                                                         header[sample_start:],
+                                                         core_rows),
+                        out_fp)
+
 
 def handle_program_options():
     parser = argparse.ArgumentParser(description="Given an abundance file,\
@@ -17,7 +204,10 @@ def handle_program_options():
                                      some percent of all samples (80 percent\
                                      by default)")
     parser.add_argument('-i', '--input_fp', required=True,
-                        help="Path and name of the gene abundance file.")
+                        help="Path and name of the gene abundance file. Use\
+                        '-' to read from standard input. This may also be a\
+                        binary table (see mgr_api.table), in which case the\
+                        last key column holds the gene IDs.")
 
     cutoff_args = parser.add_mutually_exclusive_group()
     cutoff_args.add_argument('-p', '--min_core_percent', 
@@ -29,17 +219,41 @@ def handle_program_options():
                              help="The minimum number of samples (as a whole\
                              number) a gene must be present in to be considered\
                              part of the core metagenome.")
+    cutoff_args.add_argument('--sweep', nargs=3, type=float,
+                             metavar=('MIN', 'MAX', 'STEP'),
+                             help="Compute the core metagenome size for each\
+                             minimum percent from MIN to MAX (inclusive) in\
+                             increments of STEP, e.g. --sweep 0.5 1.0 0.05,\
+                             from a single pass over the input. The output file\
+                             (-o) will contain the core size curve: one line\
+                             per threshold with the minimum percent, minimum\
+                             number of samples and number of core genes.")
+    parser.add_argument('--sweep_dir',
+                        help="With --sweep, also write the core metagenome\
+                        file for each threshold to this directory, named\
+                        core_<percent>.txt")
 
-    parser.add_argument('-s', '--sample_start_column', required=True, type=int,
+    parser.add_argument('-s', '--sample_start_column', type=int,
                         help="The column number of the first sample abundance\
                         data. This also assumes that the column containing\
                         unique IDs (e.g. KO IDs, EC Numbers, etc...) is\
-                        immediately before the sample start column.")
+                        immediately before the sample start column.\
+                        Required unless the input is a binary table.")
     parser.add_argument('-o', '--output_fp',
                         help="Path and name of the output core metagenome\
                         file. The written data will be in the same format as\
                         the input file, but retaining only those rows matching\
                         genes determined to be in the core.")
+    parser.add_argument('--binary', action='store_true',
+                        help="Write the core metagenome file(s) as binary\
+                        tables (see mgr_api.table) instead of tab-separated\
+                        text.")
+    parser.add_argument('--low_memory', action='store_true',
+                        help="Read the input twice instead of holding it in\
+                        memory: first to count gene presence, then to write\
+                        the core rows. Memory use then depends on the number\
+                        of genes, not the size of the table. Standard input\
+                        is copied to a temporary file for the second pass.")
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Prints status messages while the program is\
                               running.")
@@ -49,17 +263,104 @@ def handle_program_options():
 
 def main():
     args = handle_program_options()
+    from_stdin = args.input_fp == '-'
+    abd_table = None
+    if not from_stdin and mgtable.is_table(args.input_fp):
+        abd_table = mgtable.read_table(args.input_fp)
+        sample_start = len(abd_table.key_columns)
+        id_idx = sample_start - 1
+    elif args.sample_start_column is None:
+        sys.exit("ERROR: --sample_start_column is required for tab-separated "
+                 "input.")
+    else:
+        id_idx = args.sample_start_column-2
+        sample_start = args.sample_start_column-1
 
     # parse metagenome abundance file
-    with open(args.input_fp, 'rU') as in_f:
-        dr = csv.DictReader(in_f, delimiter="\t")
-        id_col = dr.fieldnames[args.sample_start_column-2]
-        sample_ids = dr.fieldnames[args.sample_start_column-1:]
-        abundance = [line for line in dr]
+    if abd_table is not None:
+        header = abd_table.key_columns + abd_table.samples
+        gene_ids = abd_table.keys[id_idx].values()
+        counts = table_presence_counts(abd_table.values)
+        row_counts = dict(zip(gene_ids, counts))
+        n_genes = len(abd_table)
+        abundance = abd_table.rows
+    elif args.low_memory:
+        spill_f = tempfile.TemporaryFile(mode='w+') if from_stdin else None
+        in_f = sys.stdin if from_stdin else open(args.input_fp, 'rU')
+        try:
+            header, row_counts, n_genes = stream_presence_counts(in_f,
+                                                                 sample_start,
+                                                                 spill_f)
+        finally:
+            if not from_stdin:
+                in_f.close()
+
+        def abundance():
+            # second pass over the input
+            if spill_f is not None:
+                spill_f.seek(0)
+                in_f = spill_f
+            else:
+                in_f = open(args.input_fp, 'rU')
+            reader = csv.reader(in_f, delimiter="\t")
+            next(reader)
+            for row in reader:
+                if row:
+                    yield row
+            in_f.close()
+    else:
+        in_f = sys.stdin if from_stdin else open(args.input_fp, 'rU')
+        lines = in_f.readlines()
+        if not from_stdin:
+            in_f.close()
+        header, row_counts, n_genes = stream_presence_counts(lines,
+                                                             sample_start)
+        abundance = lambda: parse_abundance(lines)[1]
+    sample_ids = header[sample_start:]
+
+    def save_cores(outputs):
+        if not args.binary:
+            write_cores(outputs, header, abundance(), id_idx)
+        elif abd_table is not None:
+            for out_fp, core in outputs:
+                mask = np.array([gene_id in core for gene_id in gene_ids],
+                                dtype=bool)
+                mgtable.write_table(abd_table.take(mask), out_fp)
+        else:
+            for out_fp, core in outputs:
+                write_core_table(out_fp, core, header, abundance(), id_idx,
+                                 sample_start)
+
+    if args.sweep:
+        percents = sweep_percents(*args.sweep)
+        curve = core_size_curve(list(row_counts.values()), len(sample_ids),
+                                percents)
+        with open(args.output_fp, 'w') as out_f:
+            out_f.write("min_core_percent\tmin_core_samples\tcore_genes\n")
+            for pct, min_core_amt, core_size in curve:
+                out_f.write("{}\t{}\t{}\n".format(pct, min_core_amt, core_size))
+
+        if args.sweep_dir:
+            if not osp.isdir(args.sweep_dir):
+                os.makedirs(args.sweep_dir)
+            outputs = []
+            for pct, min_core_amt, _ in curve:
+                core = {gene_id for gene_id in row_counts
+                        if row_counts[gene_id] >= min_core_amt}
+                core_fn = 'core_{:g}'.format(pct * 100)
+                if not args.binary:
+                    core_fn += '.txt'
+                outputs.append((osp.join(args.sweep_dir, core_fn), core))
+            save_cores(outputs)
 
-    row_counts = {row[id_col]: sum([1 if row[sid] is not "0" else 0 
-                                    for sid in sample_ids]) 
-                  for row in abundance}
+        if args.verbose:
+            print "Input samples: {}".format(len(sample_ids))
+            print "Input genes: {}".format(n_genes)
+            for pct, min_core_amt, core_size in curve:
+                msg = "{:g}% ({} samples): {} genes in core"
+                print msg.format(pct * 100, min_core_amt, core_size)
+            print "\nCore size curve written to: {}".format(args.output_fp)
+        return
 
     # detetermine core membership
     if args.min_core_samples is not None:
@@ -71,14 +372,11 @@ def main():
             if row_counts[gene_id] >= min_core_amt}
 
     # write core metagenome file
-    with open(args.output_fp, 'w') as out_f:
-        dwriter = csv.DictWriter(out_f, dr.fieldnames, delimiter="\t")
-        dwriter.writeheader()
-        dwriter.writerows([row for row in abundance if row[id_col] in core])
+    save_cores([(args.output_fp, core)])
 
     if args.verbose:
         print "Input samples: {}".format(len(sample_ids))
-        print "Input genes: {}".format(len(abundance))
+        print "Input genes: {}".format(n_genes)
         print "Samples in core: {}".format(min_core_amt)
         print "Genes in core: {}".format(len(core))
         print "\nCore file written to: {}".format(args.output_fp)
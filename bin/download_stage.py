@@ -9,12 +9,21 @@ from __future__ import absolute_import, division, print_function
 
 # standard library imports
 import argparse
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+import hashlib
 import os, os.path as osp
 import sys
 import time, datetime
+# 3rd party imports
+import requests
 # local imports
 from mgr_api import api as mgapi
+from mgr_api.ratelimit import RateLimiter
+from mgr_api.util import replace
+
+# size of each block of data read from the network and written to disk
+CHUNK_SIZE = 1024 * 1024
 
 
 def create_dir(path):
@@ -43,6 +52,110 @@ def stage_info(stage_id, mg_id, auth_key):
         stage.raise_for_status()
 
 
+class SubstageNotFound(Exception):
+    pass
+
+
+def stage_file(stage_id, substage, mg_id, auth_key):
+    """
+    Look up the stage file entry (file_id, file_name, file_size, ...) to
+    download for a metagenome. If substage is not given, the first returned
+    file entry is used.
+    """
+    sdata = stage_info(stage_id, mg_id, auth_key)['data']
+    if not isinstance(sdata, list):
+        return sdata
+    if not substage:
+        return sdata[0]
+
+    types = []
+    for entry in sdata:
+        ss_name = entry['stage_name'].split('.')[-1]
+        types.append(ss_name)
+        if ss_name == substage:
+            return entry
+    msg = "Substage '{}' not found. Available substages for stage {}: {}"
+    raise SubstageNotFound(msg.format(substage, stage_id, ', '.join(types)))
+
+
+def file_md5(fp, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as in_f:
+        for chunk in iter(lambda: in_f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def download_file(mg_id, file_id, out_fp, auth_key, file_size=None,
+                  md5=None, retries=3, chunk_size=CHUNK_SIZE):
+    """
+    Stream a stage file to disk in fixed-size chunks.
+
+    Data is written to out_fp + '.part'. If a previous attempt left a partial
+    file behind, or the connection drops, the download resumes from the end
+    of the partial file with an HTTP Range request. Once complete, the size
+    (and md5 checksum, if given) is verified against the stage information
+    before the file is atomically renamed to out_fp.
+
+    :rtype: int
+    :return: The number of bytes transferred over the network.
+    """
+    part_fp = out_fp + '.part'
+    transferred = 0
+
+    for attempt in range(retries + 1):
+        offset = os.stat(part_fp).st_size if osp.isfile(part_fp) else 0
+        if file_size is not None and offset >= file_size:
+            break
+        # ask for the raw bytes so that a byte range lines up with the file
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            resp = mgapi.mgrast_request('download', mg_id, {'file': file_id},
+                                        auth_key=auth_key, stream=True,
+                                        headers=headers)
+            with closing(resp):
+                resp.raise_for_status()
+                # the server may ignore the Range request and send the whole
+                # file, or (rarely) send a range other than the one requested
+                content_range = resp.headers.get('Content-Range', '')
+                if (resp.status_code == 206 and
+                        not content_range.startswith('bytes {}-'.format(offset))):
+                    # discard the partial file and fetch the whole file again
+                    os.remove(part_fp)
+                    if attempt == retries:
+                        raise IOError("{}: unexpected Content-Range '{}' when "
+                                      "resuming at byte {}".format(
+                                      out_fp, content_range, offset))
+                    continue
+                mode = 'ab' if resp.status_code == 206 else 'wb'
+                with open(part_fp, mode) as out_f:
+                    for chunk in resp.iter_content(chunk_size):
+                        out_f.write(chunk)
+                        transferred += len(chunk)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+            continue
+        if file_size is None:
+            break
+
+    size = os.stat(part_fp).st_size
+    if file_size is not None and size != file_size:
+        if size > file_size:
+            os.remove(part_fp)
+        raise IOError("{}: downloaded {} bytes, expected {}".format(
+                      out_fp, size, file_size))
+    if md5 and file_md5(part_fp) != md5:
+        os.remove(part_fp)
+        raise IOError("{}: md5 checksum mismatch".format(out_fp))
+
+    replace(part_fp, out_fp)
+    return transferred
+
+
 def handle_program_options():
     parser = argparse.ArgumentParser(description="Download metagenome data for\
                                      a specified stage of the MG-RAST\
@@ -76,6 +189,13 @@ def handle_program_options():
                         help="Any metagenomes to be downloaded that already\
                         exist will be re-downloaded. If --force is not\
                         specified (default), such files will be skipped.")
+    parser.add_argument('--lookup_workers', default=8, type=int,
+                        help="The number of stage information lookups to run\
+                        concurrently (default 8).")
+    parser.add_argument('--download_workers', default=4, type=int,
+                        help="The number of file downloads to run\
+                        concurrently (default 4). Files are downloaded\
+                        largest first.")
     parser.add_argument('-v', '--verbose', action='store_true')
 
     return parser.parse_args()
@@ -115,54 +235,73 @@ def main():
     #derep_passed = '150'
     #screen_passed = '299'
 
-    for mg_id in metagenomes:
-        sinfo = stage_info(args.stage_id, mg_id, args.auth_key)
-        sdata = sinfo['data']
-        types = []
-
-        if args.substage:
-            for substage in sdata:
-                ss_name = substage['stage_name'].split('.')[-1]
-                types.append(ss_name)
-                if ss_name == args.substage:
-                    sdata = substage
-                    break
-            else:
-                print("Substage '{}' not found".format(args.substage))
-                print("Available substages {}:".format(args.stage_id))
-                for ss in types:
-                    print("  {}".format(ss))
-                sys.exit(1)
-        
-        file_id = sdata['file_id']
-        file_name = sdata['file_name']
+    mgapi.set_default_client(mgapi.MGRASTClient(
+        pool_size=max(args.lookup_workers, args.download_workers),
+        rate_limiter=RateLimiter()))
+    failed = {}
 
-        # skip download if file exists, unless --force specified
-        if (osp.isfile(file_name) and os.stat(file_name).st_size == sdata['file_size'] 
-              and not args.force):
-            if args.verbose:
-                print("\t{}: data previously downloaded, skipping.".format(mg_id))
-            continue
+    # look up the stage file information for all metagenomes
+    transfers = []
+    with ThreadPoolExecutor(max_workers=args.lookup_workers) as executor:
+        lookups = {executor.submit(stage_file, args.stage_id, args.substage,
+                                   mg_id, args.auth_key): mg_id
+                   for mg_id in metagenomes}
+        for lookup in as_completed(lookups):
+            mg_id = lookups[lookup]
+            try:
+                sdata = lookup.result()
+            except Exception as ex:
+                failed[mg_id] = ex
+                continue
 
-        if args.verbose:
-            print('\tDownloading file: {}...'.format(file_name), end='')
-            sys.stdout.flush()
+            out_fp = osp.join(args.out_dir, sdata['file_name'])
+            # skip download if file exists, unless --force specified
+            if (osp.isfile(out_fp) and os.stat(out_fp).st_size == sdata['file_size']
+                  and not args.force):
+                if args.verbose:
+                    print("\t{}: data previously downloaded, skipping.".format(mg_id))
+                continue
+            transfers.append((mg_id, sdata, out_fp))
 
-        start = time.time()
-        stage = mgapi.mgrast_request('download', mg_id,
-                                     {'file': file_id},
-                                     auth_key=args.auth_key)
-        end = time.time()
+    # download the largest files first so that the slowest transfers are not
+    # left running alone at the end
+    transfers.sort(key=lambda t: t[1]['file_size'], reverse=True)
 
-        if args.verbose:
-            print("completed in: {}".format(duration(start, end)))
-        
-        out_fp = osp.join(args.out_dir, file_name)
-        with open(out_fp, 'w') as outf:
-            outf.write(StringIO(stage.text).getvalue())
+    if args.verbose and transfers:
+        total_size = sum(t[1]['file_size'] for t in transfers)
+        print("Downloading {} file(s), {:.1f} MB total, using {} worker(s)".format(
+              len(transfers), total_size / 1e6, args.download_workers))
 
-        if args.verbose:
-            print('\tData written to: ' + out_fp)
+    start = time.time()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=args.download_workers) as executor:
+        downloads = {executor.submit(download_file, mg_id, sdata['file_id'],
+                                     out_fp, args.auth_key,
+                                     file_size=sdata['file_size'],
+                                     md5=sdata.get('file_md5')): (mg_id, out_fp)
+                     for mg_id, sdata, out_fp in transfers}
+        for download in as_completed(downloads):
+            mg_id, out_fp = downloads[download]
+            try:
+                total_bytes += download.result()
+            except Exception as ex:
+                failed[mg_id] = ex
+                continue
+            if args.verbose:
+                print('\t{}: data written to: {} ({} elapsed)'.format(
+                      mg_id, out_fp, duration(start, time.time())))
+    end = time.time()
+
+    if args.verbose and transfers:
+        rate = total_bytes / max(end - start, 1e-6) / 1e6
+        print("Transferred {:.1f} MB in {} ({:.2f} MB/s)".format(
+              total_bytes / 1e6, duration(start, end), rate))
+
+    if failed:
+        print("{} metagenome(s) failed:".format(len(failed)), file=sys.stderr)
+        for mg_id in sorted(failed):
+            print("  {}: {}".format(mg_id, failed[mg_id]), file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
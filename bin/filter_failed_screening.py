@@ -10,9 +10,11 @@ from __future__ import print_function
 # standard library imports
 import argparse
 from io import StringIO
+from itertools import islice
 import os.path as osp
 import sys
 # 3rd party imports
+import numpy as np
 from skbio import util as skbu, SequenceCollection
 # local imports
 from mgr_api import api as mgapi
@@ -45,6 +47,200 @@ def filter_seqs(seqs, remove_ids):
     return SequenceCollection([seq for seq in seqs if seq.id not in remove_ids])
 
 
+def iter_fastq(lines):
+    """
+    Given an iterable of FASTQ-format lines (without line endings), yield
+    each record as a tuple of its four lines: header, sequence, '+' line and
+    quality scores. Records are passed through untouched, so no quality
+    score decoding takes place. Multi-line sequence records are not
+    supported.
+    """
+    lines = iter(lines)
+    for header in lines:
+        if not header.strip():
+            continue
+        try:
+            yield header, next(lines), next(lines), next(lines)
+        except StopIteration:
+            raise ValueError("Truncated FASTQ record: {}".format(header))
+
+
+def read_id(header):
+    """
+    Return the sequence ID from a FASTQ header line: the text following
+    the '@' up to the first whitespace.
+    """
+    return header[1:].split(None, 1)[0]
+
+
+class HashedIDSet(object):
+    """
+    A compact, read-only set of sequence IDs for very large read sets.
+
+    Rather than the ID strings (~100 bytes each in a frozenset), only a
+    sorted array of their 64-bit hashes is kept (8 bytes each), along with
+    the number of IDs sharing each hash, and membership is tested for whole
+    batches of IDs at once.
+
+    Hash membership alone could report a false match if two different IDs
+    share a hash, so every lookup also counts how often each stored hash is
+    matched. The set is meant to be queried with a collection of IDs that
+    contains all of its members (e.g. Dereplication Passed IDs tested
+    against the Screen Passed set): a hash held by one ID and matched
+    exactly once was then matched by that ID alone. verify() reports
+    whether any hash was shared or matched more than once, in which case
+    resolve() keeps the exact IDs of those hashes only, and the lookups
+    must be repeated. verify() raises a ValueError if a member was never
+    matched, as the lookups could then have been misclassified unnoticed.
+
+    NOTE: The hashes are only stable within a single Python process.
+    """
+    MASK = (1 << 64) - 1
+
+    def __init__(self, ids, batch_size=100000):
+        ids = iter(ids)
+        self.n_ids = 0
+        hash_batches, count_batches = [], []
+        while True:
+            batch = list(islice(ids, batch_size))
+            if not batch:
+                break
+            self.n_ids += len(batch)
+            hashes, counts = np.unique(self._hashes(batch), return_counts=True)
+            hash_batches.append(hashes)
+            count_batches.append(counts)
+        if hash_batches:
+            self.hashes, idx = np.unique(np.concatenate(hash_batches),
+                                         return_inverse=True)
+            self.counts = np.bincount(idx,
+                                      weights=np.concatenate(count_batches),
+                                      minlength=len(self.hashes))
+            self.counts = self.counts.astype(np.int64)
+        else:
+            self.hashes = np.empty(0, dtype=np.uint64)
+            self.counts = np.empty(0, dtype=np.int64)
+        del hash_batches, count_batches
+        self.hits = np.zeros(len(self.hashes), dtype=np.uint32)
+        # hashes looked up by exact ID after resolve(), and the match count
+        # of each of their IDs
+        self.resolved = np.zeros(len(self.hashes), dtype=bool)
+        self.exact = {}
+
+    def __len__(self):
+        return self.n_ids
+
+    def _hashes(self, ids):
+        # the 64-bit hash of each ID in a list
+        return np.fromiter((hash(seq_id) & self.MASK for seq_id in ids),
+                           dtype=np.uint64, count=len(ids))
+
+    def contains_many(self, ids):
+        """
+        Return a boolean array indicating which of the given IDs (a list)
+        are in the set, recording the match for verify().
+        """
+        query = self._hashes(ids)
+        if not len(self.hashes):
+            return np.zeros(len(query), dtype=bool)
+        pos = np.searchsorted(self.hashes, query)
+        pos[pos == len(self.hashes)] = 0
+        found = self.hashes[pos] == query
+        np.add.at(self.hits, pos[found], 1)
+        for i in np.flatnonzero(found & self.resolved[pos]):
+            if ids[i] in self.exact:
+                self.exact[ids[i]] += 1
+            else:
+                found[i] = False
+        return found
+
+    def __contains__(self, seq_id):
+        return bool(self.contains_many([seq_id])[0])
+
+    def verify(self):
+        """
+        Return True if no hash collision could have affected the lookups
+        made so far (see class description).
+
+        :raises ValueError: If an ID in the set was never matched, i.e. the
+                            IDs looked up did not include all of the set.
+        """
+        hashed = ~self.resolved
+        missing = (np.count_nonzero(hashed & (self.hits < self.counts)) +
+                   sum(1 for n in self.exact.values() if n == 0))
+        if missing:
+            raise ValueError("{} of {} IDs in the set were not found among the "
+                             "IDs looked up".format(missing, self.n_ids))
+        return bool(np.all(self.resolved |
+                           ((self.counts == 1) & (self.hits == 1))))
+
+    def resolve(self, ids, batch_size=100000):
+        """
+        Make lookups exact for the hashes that verify() found ambiguous by
+        keeping the IDs that have those hashes. ids must yield the IDs of
+        the set again. The match counts are reset, so the lookups must be
+        repeated.
+        """
+        self.resolved |= (self.counts != 1) | (self.hits != 1)
+        ambiguous = self.hashes[self.resolved]
+        self.exact = {}
+        ids = iter(ids)
+        while True:
+            batch = list(islice(ids, batch_size))
+            if not batch:
+                break
+            for i in np.flatnonzero(np.isin(self._hashes(batch), ambiguous)):
+                self.exact[batch[i]] = 0
+        self.hits[:] = 0
+
+
+def write_filtered_fastq(lines, remove_ids, out_f, batch_size=100000):
+    """
+    Stream FASTQ-format lines and write each record whose ID is not in
+    remove_ids to out_f as it is read. Records are tested for membership
+    in batches when remove_ids supports it (see HashedIDSet).
+
+    :rtype: tuple
+    :return: The number of records written and the number removed.
+    """
+    if hasattr(remove_ids, 'contains_many'):
+        contains_many = remove_ids.contains_many
+    else:
+        contains_many = lambda ids: [seq_id in remove_ids for seq_id in ids]
+
+    written = removed = 0
+    records = iter_fastq(lines)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        for rec, found in zip(batch, contains_many([read_id(rec[0])
+                                                    for rec in batch])):
+            if found:
+                removed += 1
+                continue
+            out_f.write('\n'.join(rec) + '\n')
+            written += 1
+    return written, removed
+
+
+def response_lines(resp, chunk_size=1024*1024):
+    """
+    Lazily iterate over the lines of a streamed HTTP response.
+    """
+    # without a charset in the response headers, iter_lines yields bytes
+    resp.encoding = resp.encoding or 'utf-8'
+    return resp.iter_lines(chunk_size=chunk_size, decode_unicode=True)
+
+
+def file_lines(fp):
+    """
+    Lazily iterate over the lines of a file, without line endings.
+    """
+    with open(fp) as in_f:
+        for line in in_f:
+            yield line.rstrip('\r\n')
+
+
 def parse_metagenome_file(mg_fp):
     """
     Read in and return a list of metagenome IDs in a file, one per line.
@@ -55,6 +251,63 @@ def parse_metagenome_file(mg_fp):
     return metagenomes
 
 
+def filter_metagenome_stream(mg_id, args, derep_passed, screen_passed):
+    """
+    Write the sequences of one metagenome that failed screening, streaming
+    the data from MG-RAST (or local files) rather than loading it.
+    """
+    def lines(file_id, local_fp):
+        if local_fp:
+            return file_lines(local_fp)
+        rsp = mgapi.mgrast_request('download', mg_id, {'file': file_id},
+                                   auth_key=args.auth_key, stream=True)
+        return response_lines(rsp)
+
+    if args.verbose:
+        print('Processing metagenome: {}'.format(mg_id))
+        print('\tReading: Screen Passed IDs...', end='')
+        sys.stdout.flush()
+    screenp_ids = HashedIDSet(read_id(rec[0]) for rec in
+                              iter_fastq(lines(screen_passed,
+                                               args.screen_passed_fp)))
+    if args.verbose:
+        print('{} sequences'.format(len(screenp_ids)))
+        print('\tFiltering: Dereplication Passed...')
+
+    out_fp = osp.join(args.out_dir, mg_id + '_screen_failed.fastq')
+    with open(out_fp, 'w') as out_f:
+        written, removed = write_filtered_fastq(lines(derep_passed,
+                                                      args.derep_passed_fp),
+                                                screenp_ids, out_f)
+
+    def verify():
+        # screen passed reads are a subset of the dereplication passed reads
+        try:
+            return screenp_ids.verify()
+        except ValueError as ex:
+            raise ValueError("{}: Screen Passed reads missing from "
+                             "Dereplication Passed: {}".format(mg_id, ex))
+
+    # a read ID hash collision could have misclassified reads, so redo the
+    # filtering with the exact IDs of the colliding hashes
+    if not verify():
+        if args.verbose:
+            print('\tRead ID hash collision detected, refiltering with exact IDs')
+        screenp_ids.resolve(read_id(rec[0]) for rec in
+                            iter_fastq(lines(screen_passed,
+                                             args.screen_passed_fp)))
+        with open(out_fp, 'w') as out_f:
+            written, removed = write_filtered_fastq(lines(derep_passed,
+                                                          args.derep_passed_fp),
+                                                    screenp_ids, out_f)
+        verify()
+
+    if args.verbose:
+        print('\tRemoved {} sequences from Dereplication Passed'.format(removed))
+        print('\tleaving {} sequences'.format(written))
+        print('Sequence data written to: ' + out_fp)
+
+
 def handle_program_options():
     parser = argparse.ArgumentParser(description="Extract the set of sequences\
                                      that were filtered out after the MG-RAST\
@@ -79,6 +332,19 @@ def handle_program_options():
                               the current directory). One FASTA-format file\
                               will be created for each specified metagenome\
                               and saved in this directory.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream the sequence data instead of loading it\
+                        into memory. Only the Screen Passed sequence IDs are\
+                        held in memory; Dereplication Passed records are\
+                        read and written out one at a time, unmodified.")
+    parser.add_argument('--derep_passed_fp',
+                        help="Read the Dereplication Passed FASTQ data from\
+                        this file instead of downloading it (with --stream\
+                        and a single metagenome ID only).")
+    parser.add_argument('--screen_passed_fp',
+                        help="Read the Screen Passed FASTQ data from this file\
+                        instead of downloading it (with --stream and a single\
+                        metagenome ID only).")
     parser.add_argument('-v', '--verbose', action='store_true')
 
     return parser.parse_args()
@@ -109,7 +375,17 @@ def main():
     derep_passed = '150.1'
     screen_passed = '299.1'
 
+    if ((args.derep_passed_fp or args.screen_passed_fp) and
+            (not args.stream or len(metagenomes) != 1)):
+        print("--derep_passed_fp and --screen_passed_fp require --stream and\
+ a single metagenome ID (-m)", file=sys.stderr)
+        sys.exit(1)
+
     for mg_id in metagenomes:
+        if args.stream:
+            filter_metagenome_stream(mg_id, args, derep_passed, screen_passed)
+            continue
+
         if args.verbose:
             print('Processing metagenome: {}'.format(mg_id))
             print('\tDownloading: Dereplication Passed...', end='')
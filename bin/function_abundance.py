@@ -45,6 +45,10 @@ def handle_program_options():
                         Subsystems, NOG, COG, KO. Default is Subsystems.")
     parser.add_argument('-o', '--output_fp', default='function_abundance.biom',
                         help="The path to the result file.")
+    parser.add_argument('--cache_dir',
+                        help="Cache MG-RAST API responses in this directory \
+                        so that repeated runs for the same metagenomes do \
+                        not download the data again.")
     parser.add_argument('-v', '--verbose', action='store_true')
 
     return parser.parse_args()
@@ -52,6 +56,8 @@ def handle_program_options():
 
 def main():
     args = handle_program_options()
+    if args.cache_dir:
+        mgapi.enable_cache(args.cache_dir)
 
     metagenomes = []
     if args.metagenome_ids is not None:
@@ -6,6 +6,9 @@ FASTA format.
 """
 # standard library imports
 import argparse
+import gzip
+import os, os.path as osp
+import sys
 # local imports
 from mgr_api import api as mgapi
 
@@ -20,6 +23,43 @@ def write_annotated_fasta(data, outFN):
     with open(outFN, 'w') as outF:
         outF.write('\n'.join(['>{} {} {}\n{}'.format(entry[0], entry[1], entry[3], entry[2]) for entry in data]))
 
+
+def write_fasta_records(data, outF):
+    """
+    Write annotated sequence rows (see write_annotated_fasta()) to a binary
+    file object as they are produced, returning the number of records.
+    """
+    count = 0
+    for entry in data:
+        outF.write('>{} {} {}\n{}\n'.format(entry[0], entry[1], entry[3], entry[2]).encode('utf-8'))
+        count += 1
+    return count
+
+
+def read_checkpoint(checkpointFN):
+    """
+    Read the download settings recorded in a checkpoint file (see
+    checkpoint_settings()), the list of metagenome IDs already written to
+    the output file and the size of the output file after the last of them
+    was written. The settings are None if there is no checkpoint file.
+    """
+    settings, done, offset = None, [], 0
+    if osp.isfile(checkpointFN):
+        with open(checkpointFN) as inF:
+            settings = inF.readline().rstrip('\n')
+            for line in inF:
+                mg_id, offset = line.rstrip('\n').split('\t')
+                done.append(mg_id)
+                offset = int(offset)
+    return settings, done, offset
+
+
+def checkpoint_settings(database, dtype, compress):
+    """
+    Return the checkpoint file header line recording the settings that
+    determine the contents of the output file.
+    """
+    return '#\t{}\t{}\t{}'.format(database, dtype, 'gzip' if compress else 'plain')
         
 def parse_metagenome_file(mgFN):
     """
@@ -54,6 +94,12 @@ def handle_program_options():
                         organism, function, ontology, feature, md5. Default is function.")
     parser.add_argument('-o', '--output_fp',
                         help="The path to the result file.")
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help="Write gzip-compressed output. This is also\
+                              enabled when the output file name ends in .gz")
+    parser.add_argument('--restart', action='store_true',
+                        help="Discard the progress of a previous, interrupted\
+                              run and download all metagenomes again.")
     parser.add_argument('-v', '--verbose', action='store_true')
 
     return parser.parse_args()
@@ -70,21 +116,54 @@ def main():
     elif args.metagenome_file is not None:
         metagenomes.extend(parse_metagenome_file(args.metagenome_file))
 
-    seq_data = []
-    for mg_id in metagenomes:
-        if args.verbose:
-            print 'Downloading {} {} annotated sequence data for metagenome ID {}...'.format(args.database, args.type, mg_id)
+    # metagenomes written out by a previous, interrupted run are skipped, and
+    # any partial data written after them is discarded
+    checkpointFN = args.output_fp + '.checkpoint'
+    compress = args.gzip or args.output_fp.endswith('.gz')
+    settings = checkpoint_settings(args.database, args.type, compress)
+    if args.restart and osp.isfile(checkpointFN):
+        os.remove(checkpointFN)
+    saved_settings, done, offset = read_checkpoint(checkpointFN)
+    if saved_settings is not None and saved_settings != settings:
+        sys.exit("ERROR: {} was partially written with different --database, "
+                 "--type or --gzip options. Use --restart to discard it and "
+                 "start over.".format(args.output_fp))
 
-        d = mgapi.sequence_annotation(mg_id, args.database, args.type, args.auth_key)
-        seq_data.extend(d)
-        
-        if args.verbose:
-            print '{} sequence records downloaded'.format(len(d))
+    with open(args.output_fp, 'r+b' if osp.isfile(args.output_fp) else 'wb') as outF, \
+         open(checkpointFN, 'a') as checkpointF:
+        if saved_settings is None:
+            checkpointF.write(settings + '\n')
+            checkpointF.flush()
+        outF.truncate(offset)
+        outF.seek(offset)
+
+        for mg_id in metagenomes:
+            if mg_id in done:
+                if args.verbose:
+                    print 'Metagenome ID {} previously written, skipping.'.format(mg_id)
+                continue
+
+            if args.verbose:
+                print 'Downloading {} {} annotated sequence data for metagenome ID {}...'.format(args.database, args.type, mg_id)
+
+            d = mgapi.iter_sequence_annotation(mg_id, args.database, args.type, args.auth_key)
+            # each metagenome is a complete gzip member; concatenated members
+            # form a valid gzip file
+            mgF = gzip.GzipFile(fileobj=outF, mode='wb') if compress else outF
+            count = write_fasta_records(d, mgF)
+            if compress:
+                mgF.close()
+            outF.flush()
+            os.fsync(outF.fileno())
+
+            checkpointF.write('{}\t{}\n'.format(mg_id, outF.tell()))
+            checkpointF.flush()
+
+            if args.verbose:
+                print '{} sequence records downloaded'.format(count)
 
-    # write out final list of sequence data
-    with open(args.output_fp, 'w') as outF:
-        for entry in seq_data:
-            outF.write('>{} {} {}\n{}\n'.format(entry[0], entry[1], entry[3], entry[2]))
+    # the output file is complete, so there is nothing left to resume
+    os.remove(checkpointFN)
 
     if args.verbose:
         print 'Sequence data written to: ' + args.output_fp
@@ -9,7 +9,7 @@ import argparse
 from collections import namedtuple
 import json
 # local imports
-from mgr_api.api import mgrast_request, MGRASTException
+from mgr_api.api import mgrast_request, enable_cache, MGRASTException
 
 
 STAT_FIELDS = ['raw_seq_count', 'failed_qc', 'passed_qc',
@@ -126,6 +126,10 @@ def handle_program_options():
     parser.add_argument('-o', '--output_filename', default='meta_stats.txt',
                         help="The name of the file the project summary \
                         information will be written to.")
+    parser.add_argument('--cache_dir',
+                        help="Cache MG-RAST API responses in this directory \
+                        so that repeated runs against the same project do \
+                        not download the data again.")
 
 #    parser.add_argument('-v', '--verbose', action='store_true')
 
@@ -135,6 +139,8 @@ def handle_program_options():
 def main():
     """Program entry point"""
     args = handle_program_options()
+    if args.cache_dir:
+        enable_cache(args.cache_dir)
 
     mt_proj = metagenome_project_stats(args.project_id, args.auth_key)
     if mt_proj is None:
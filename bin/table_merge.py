@@ -4,27 +4,297 @@
 Take multiple transposed abundance tables (see abundance_table_transpose.py)
 and merge them on the list of functions (level 1...level4), e.g. KEGG or mg_func
 data.
+
+With --streaming, each table is sorted on disk by its key columns (or read
+as-is with --presorted) and the tables are merged in a single pass, so that
+memory use scales with the number of tables rather than the number of rows.
 """
 import argparse
-from collections import defaultdict, Counter
+from array import array
 import csv
+import heapq
+from itertools import groupby, islice
+from operator import itemgetter
+import sys
+import tempfile
+
+import numpy as np
+
+from mgr_api import table as mgtable
+
+
+def parse_value(value):
+    """
+    Parse an abundance value, returning it as a float and whether it is
+    written exactly as format_value() would write it back.
+    """
+    try:
+        number = float(int(value))
+        return number, '%d' % number == value
+    except ValueError:
+        try:
+            number = float(value)
+        except ValueError:
+            return 0.0, False
+        return number, not number.is_integer() and repr(number) == value
+
+
+def format_value(number):
+    return '%d' % number if number.is_integer() else repr(number)
+
+
+class SparseAbundance(object):
+    """
+    Merged abundance data stored as sparse integer-indexed arrays. Row keys
+    ("@@"-joined key column values) and metagenome IDs are each mapped to an
+    integer index, and every non-zero value is stored once, parsed, as a
+    (row, column, value) triple. Values that would not be written back
+    exactly as read (e.g. '1.50') keep their original text.
+    """
+    def __init__(self):
+        self.keys = {}
+        self.mg_idx = {}
+        self.rows = array('i')
+        self.cols = array('i')
+        self.values = array('d')
+        self.text = {}
+        self.replaced = False
+        self._parsed = {}
+
+    def _parse(self, value):
+        parsed = self._parsed.get(value)
+        if parsed is None:
+            parsed = parse_value(value)
+            if len(self._parsed) < 100000:
+                self._parsed[value] = parsed
+        return parsed
+
+    def add_rows(self, mg_ids, rows):
+        """
+        Add the (key, row number, values) rows of a table (see
+        read_keyed_rows()) whose values are in mg_ids order. A later value
+        for the same key and metagenome ID replaces an earlier one.
+        """
+        if not mg_ids:
+            return
+        new_cols = not any(mg_id in self.mg_idx for mg_id in mg_ids)
+        cols = [self.mg_idx.setdefault(mg_id, len(self.mg_idx))
+                for mg_id in mg_ids]
+        table_keys = set()
+        for key, _, values in rows:
+            row = self.keys.setdefault(key, len(self.keys))
+            # zeros are only stored where they may replace an earlier value
+            keep_zeros = not new_cols or key in table_keys
+            table_keys.add(key)
+            self.replaced |= keep_zeros
+            for col, value in zip(cols, values):
+                number, exact = self._parse(value)
+                if exact and number == 0 and not keep_zeros:
+                    continue
+                if not exact:
+                    self.text[len(self.values)] = value
+                self.rows.append(row)
+                self.cols.append(col)
+                self.values.append(number)
 
+    def iter_rows(self, mgids):
+        """
+        Iterate over the merged rows in key order as (key, values) pairs,
+        where values are strings in mgids order and missing values are '0'.
+        """
+        keys = sorted(self.keys, key=self.keys.get)
+        rows = np.frombuffer(self.rows, dtype=np.intc)
+        cols = np.frombuffer(self.cols, dtype=np.intc)
+        values = np.frombuffer(self.values, dtype=np.float64)
+        n_cols = len(self.mg_idx)
 
-def add_data(mg_func, table, key_cols):
-    for entry in table:
-        key = "@@".join(["{}" for _ in range(len(key_cols))]).format(*[entry[label] for label in key_cols])
-        for ekey in entry:
-            if ekey not in key_cols:
-                mg_func[key][ekey] = entry[ekey]
+        entries = np.arange(len(values))
+        if self.replaced:
+            # keep only the last value given for each cell, then drop zeros
+            cells = rows.astype(np.int64) * n_cols + cols
+            _, first_rev = np.unique(cells[::-1], return_index=True)
+            entries = len(cells) - 1 - first_rev
+            has_text = np.zeros(len(cells), dtype=bool)
+            has_text[list(self.text)] = True
+            entries = entries[(values[entries] != 0) | has_text[entries]]
+
+        # order the entries by key, then gather them into rows (CSR)
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        key_rank = np.empty(len(keys), dtype=np.intc)
+        key_rank[order] = np.arange(len(keys), dtype=np.intc)
+        entries = entries[np.lexsort((cols[entries], key_rank[rows[entries]]))]
+        indptr = np.searchsorted(key_rank[rows[entries]],
+                                 np.arange(len(keys) + 1)).tolist()
+        entry_cols = cols[entries]
+        entry_values = values[entries]
+
+        out_cols = [self.mg_idx[mgid] for mgid in mgids]
+        for rank, row in enumerate(order):
+            start, end = indptr[rank], indptr[rank + 1]
+            row_values = ['0'] * n_cols
+            for entry, col, number in zip(entries[start:end].tolist(),
+                                          entry_cols[start:end].tolist(),
+                                          entry_values[start:end].tolist()):
+                row_values[col] = (self.text[entry] if entry in self.text
+                                   else format_value(number))
+            yield keys[row], [row_values[col] for col in out_cols]
 
 
 def write_table(mg_func, mgids, key_cols, out_fp):
+    write_rows(mg_func.iter_rows(mgids), mgids, key_cols, out_fp)
+
+
+def write_rows(rows, mgids, key_cols, out_fp):
+    """
+    Write merged (key, values) rows, in key order, as a tab-separated table.
+    """
     with open(out_fp, 'w') as out_f:
         out_f.write('\t'.join(key_cols) + '\t')
         out_f.write('\t'.join(mgids) + '\n')
-        for func in sorted(mg_func.keys()):
+        for func, values in rows:
             out_f.write('\t'.join(func.split('@@')) + '\t')
-            out_f.write('\t'.join([mg_func[func][mgid] if mgid in mg_func[func] else '0' for mgid in mgids]) + '\n')
+            out_f.write('\t'.join(values) + '\n')
+
+
+def write_binary_table(rows, mgids, key_cols, out_fp):
+    """
+    Write merged (key, values) rows as a binary table (see mgr_api.table).
+    """
+    abd_table = mgtable.AbundanceTable.from_rows(
+        key_cols, mgids, ((func.split('@@'), values) for func, values in rows))
+    mgtable.write_table(abd_table, out_fp)
+
+
+def _read_table_rows(fp):
+    # the rows of a tab-separated or binary table as lists of strings,
+    # starting with the header
+    if mgtable.is_table(fp):
+        abd_table = mgtable.read_table(fp)
+        yield abd_table.key_columns + abd_table.samples
+        for row in abd_table.rows():
+            yield row
+    else:
+        with open(fp, 'rU') as fh:
+            for row in csv.reader(fh, delimiter='\t'):
+                yield row
+
+
+def read_keyed_rows(fp, key_cols):
+    """
+    Open a transposed abundance table (tab-separated or binary) and return
+    its (sorted) metagenome IDs and an iterator over its rows as (key, row
+    number, values) tuples, where key is the "@@"-joined key column values
+    and values are in metagenome ID order.
+    """
+    csvr = _read_table_rows(fp)
+    header = next(csvr)
+    col_idx = {label: i for i, label in enumerate(header)}
+    key_idx = [col_idx[label] for label in key_cols]
+    mg_ids = sorted([col_id for col_id in col_idx if col_id not in key_cols])
+    mg_idx = [col_idx[mg_id] for mg_id in mg_ids]
+    width = len(header)
+
+    def rows():
+        for n, row in enumerate(csvr):
+            if not row:
+                continue
+            if len(row) < width:
+                row += [''] * (width - len(row))
+            yield ("@@".join([row[i] for i in key_idx]), n,
+                   [row[i] for i in mg_idx])
+
+    return mg_ids, rows()
+
+
+def check_sorted(rows, fp):
+    """
+    Pass rows through, exiting with an error if their keys are not in
+    ascending order.
+    """
+    last = None
+    for row in rows:
+        if last is not None and row[0] < last:
+            sys.exit("ERROR: {} is not sorted on its key columns (found '{}' "
+                     "after '{}').".format(fp, row[0], last))
+        last = row[0]
+        yield row
+
+
+# the most sorted runs merged at once
+MERGE_WIDTH = 64
+
+
+def _read_run(run_f):
+    with run_f:
+        for row in csv.reader(run_f, delimiter='\t'):
+            yield row[0], int(row[1]), row[2:]
+
+
+def _write_run(rows, tmp_dir):
+    # write sorted rows to a temporary file and read them back lazily
+    run_f = tempfile.TemporaryFile(mode='w+', dir=tmp_dir)
+    csvw = csv.writer(run_f, delimiter='\t', lineterminator='\n')
+    for key, n, values in rows:
+        csvw.writerow([key, n] + values)
+    run_f.seek(0)
+    return _read_run(run_f)
+
+
+def sort_rows(rows, chunk_rows=500000, tmp_dir=None, max_runs=MERGE_WIDTH):
+    """
+    Sort (key, row number, values) rows on key, preserving the original
+    order of rows with equal keys. Rows are sorted in chunks of chunk_rows,
+    and each sorted chunk is written to a temporary file to be merged back
+    together, so that only one chunk is held in memory at a time.
+
+    Each temporary file stays open until it is merged, so whenever
+    MERGE_WIDTH runs are open the shortest of them are merged into one longer
+    run, and the runs left at the end are merged down to at most max_runs.
+    """
+    runs = []  # (level, run), with levels non-increasing
+    chunk = list(islice(rows, chunk_rows))
+    while chunk:
+        if len(runs) == MERGE_WIDTH:
+            # merge the runs at the lowest level, along with the level above
+            # it if there is only one of them
+            levels = [level for level, _ in runs]
+            start = levels.index(levels[-1])
+            if start == len(runs) - 1:
+                start = levels.index(levels[start - 1])
+            batch = [run for _, run in runs[start:]]
+            runs[start:] = [(levels[start] + 1,
+                             _write_run(heapq.merge(*batch), tmp_dir))]
+        chunk.sort(key=itemgetter(0, 1))
+        runs.append((0, _write_run(chunk, tmp_dir)))
+        chunk = list(islice(rows, chunk_rows))
+    runs = [run for _, run in runs]
+    max_runs = max(max_runs, 1)
+    while len(runs) > max_runs:
+        width = min(MERGE_WIDTH, len(runs) - max_runs + 1)
+        runs[-width:] = [_write_run(heapq.merge(*runs[-width:]), tmp_dir)]
+    return heapq.merge(*runs)
+
+
+def _tag_rows(rows, table_idx):
+    for key, n, values in rows:
+        yield key, table_idx, n, values
+
+
+def merge_sorted(tables, mg_ids):
+    """
+    Merge tables of key-sorted (key, row number, values) rows, each paired
+    with its metagenome IDs, into (key, values) rows in key order, with
+    values in mg_ids order and missing values as '0'. Where tables share a
+    metagenome ID for the same key, the value from the later table is used.
+    """
+    merged = heapq.merge(*[_tag_rows(rows, i)
+                           for i, (_, rows) in enumerate(tables)])
+
+    for func, group in groupby(merged, key=itemgetter(0)):
+        abd = {}
+        for _, table_idx, _, values in group:
+            abd.update(zip(tables[table_idx][0], values))
+        yield func, [abd.get(mgid, '0') for mgid in mg_ids]
 
 
 def parse_key_columns(fp, stop_col):
@@ -34,10 +304,10 @@ def parse_key_columns(fp, stop_col):
     stop_col for use as a unique key in identifying
     rows.
     """
-    with open(fp, 'rU') as fh:
-        csvr = csv.reader(fh, delimiter="\t")
-        header = csvr.next()
-        return header[:stop_col]
+    csvr = _read_table_rows(fp)
+    header = next(csvr)
+    csvr.close()
+    return header[:stop_col]
 
 
 def handle_program_options():
@@ -49,7 +319,9 @@ def handle_program_options():
                                      list of functions (level 1...level 4),\
                                      e.g. KEGG or mg_func data.")
     parser.add_argument('abd_table_fps', nargs="+",
-                        help="Paths to two or more transposed abundance tables.")
+                        help="Paths to two or more transposed abundance tables.\
+                              Each may be tab-separated or a binary table (see\
+                              mgr_api.table).")
     parser.add_argument('--stop_column', default=1, type=int,
                         help="The index of the last column before the abundance\
                               data begins. All columns up to and including this\
@@ -57,6 +329,29 @@ def handle_program_options():
                               identify rows for the merge operation.")
     parser.add_argument('-o', '--output_fp', default="merged_table.txt",
                         help="The output file path.")
+    parser.add_argument('--binary', action='store_true',
+                        help="Write the merged table as a binary table (see\
+                              mgr_api.table) instead of tab-separated text.\
+                              Values are stored as numbers, so they are read\
+                              back exactly as written only for integer tables\
+                              and for float tables that write whole numbers\
+                              consistently (all as '1' or all as '1.0'); e.g.\
+                              '1.50' is read back as '1.5'.")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Sort each table by its key columns on disk and\
+                              merge the sorted tables in a single pass, rather\
+                              than loading all of the tables into memory.")
+    parser.add_argument('--presorted', action='store_true',
+                        help="The input tables are already sorted by their key\
+                              columns (as the '@@'-joined key string), so they\
+                              can be merged directly. Implies --streaming.")
+    parser.add_argument('--chunk_rows', default=500000, type=int,
+                        help="With --streaming, the number of rows of a table\
+                              to sort in memory at once. Default: 500000")
+    parser.add_argument('--tmp_dir',
+                        help="With --streaming, the directory in which to store\
+                              sorted chunks of the tables. Defaults to the\
+                              system temporary directory.")
 
     return parser.parse_args()
 
@@ -64,18 +359,35 @@ def handle_program_options():
 def main():
     args = handle_program_options()
 
-    mg_func_abd = defaultdict(lambda : defaultdict(str))
+    mg_func_abd = SparseAbundance()
     mg_ids = []
 
     key_cols = parse_key_columns(args.abd_table_fps[0], args.stop_column)
 
-    for fp in args.abd_table_fps:
-        with open(fp, 'rU') as fh:
-            abd_table = [line for line in csv.DictReader(fh, delimiter='\t')]
-            add_data(mg_func_abd, abd_table, key_cols)
-            mg_ids.extend(sorted([col_id for col_id in abd_table[0] if col_id not in key_cols]))
+    if args.streaming or args.presorted:
+        tables = []
+        for fp in args.abd_table_fps:
+            table_mg_ids, rows = read_keyed_rows(fp, key_cols)
+            if args.presorted:
+                rows = check_sorted(rows, fp)
+            else:
+                # share MERGE_WIDTH open runs between the tables
+                rows = sort_rows(rows, args.chunk_rows, args.tmp_dir,
+                                 MERGE_WIDTH // len(args.abd_table_fps))
+            tables.append((table_mg_ids, rows))
+            mg_ids.extend(table_mg_ids)
+        merged = merge_sorted(tables, mg_ids)
+    else:
+        for fp in args.abd_table_fps:
+            table_mg_ids, rows = read_keyed_rows(fp, key_cols)
+            mg_func_abd.add_rows(table_mg_ids, rows)
+            mg_ids.extend(table_mg_ids)
+        merged = mg_func_abd.iter_rows(mg_ids)
 
-    write_table(mg_func_abd, mg_ids, key_cols, args.output_fp)
+    if args.binary:
+        write_binary_table(merged, mg_ids, key_cols, args.output_fp)
+    else:
+        write_rows(merged, mg_ids, key_cols, args.output_fp)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,190 @@
+from argparse import Namespace
+import os.path as osp
+import shutil
+import tempfile
 import unittest
 
+import numpy as np
+
+from abundance_table_transpose import SubsystemAbundance, abundance_table
+from core_metagenome import (presence_counts, core_size_curve, sweep_percents,
+                             parse_abundance, stream_presence_counts)
+import filter_failed_screening
+from filter_failed_screening import (HashedIDSet, iter_fastq,
+                                     write_filtered_fastq)
 from project_stats import metagenome_project_stats
+import table_merge
+from table_merge import SparseAbundance, sort_rows
 
 class Test_mgrast_project_stats(unittest.TestCase):            
     def test_no_project(self):
         mg_stats = metagenome_project_stats('1000', '')
         self.assertEquals(mg_stats, None)
+
+
+class Test_core_metagenome(unittest.TestCase):
+    def test_presence_counts(self):
+        lines = ['K1\t0\t3\t0.0\n', 'K2\t1.5\t\t2\n', 'K3\t0\n']
+        ids, counts = presence_counts(lines, 1, 3)
+        self.assertEquals(ids, ['K1', 'K2', 'K3'])
+        self.assertEquals(list(counts), [1, 2, 0])
+        # non-numeric cells count as absent; quoted fields use the csv module
+        lines = ['K1\tNA\t3\tnan\n', '"K\t2"\t1\t2\t\n']
+        ids, counts = presence_counts(lines, 1, 3)
+        self.assertEquals(ids, ['K1', 'K\t2'])
+        self.assertEquals(list(counts), [1, 2])
+
+    def test_blank_lines(self):
+        lines = ['id\tmg1\tmg2\n', 'K1\t0\t3\n', '\n', 'K2\t1\t2\n', '\n']
+        header, rows = parse_abundance(iter(lines))
+        self.assertEquals(rows, [['K1', '0', '3'], ['K2', '1', '2']])
+        header, gene_counts, n_rows = stream_presence_counts(iter(lines), 1)
+        self.assertEquals(gene_counts, {'K1': 1, 'K2': 2})
+        self.assertEquals(n_rows, 2)
+
+    def test_core_size_curve(self):
+        percents = sweep_percents(0.0, 1.0, 0.25)
+        self.assertEquals(percents, [0.0, 0.25, 0.5, 0.75, 1.0])
+        curve = core_size_curve([0, 1, 2, 4, 4], 4, percents)
+        self.assertEquals(curve, [(0.0, 0, 5), (0.25, 1, 4), (0.5, 2, 3),
+                                  (0.75, 3, 2), (1.0, 4, 2)])
+
+
+class Test_table_merge(unittest.TestCase):
+    def test_sort_rows(self):
+        rows = [('L2@@F1', 0, ['1']), ('L1@@F2', 1, ['2']),
+                ('L2@@F1', 2, ['3']), ('L1@@F1', 3, ['4']),
+                ('L1@@F2', 4, ['5'])]
+        self.assertEquals(list(sort_rows(iter(rows), chunk_rows=2)),
+                          [('L1@@F1', 3, ['4']), ('L1@@F2', 1, ['2']),
+                           ('L1@@F2', 4, ['5']), ('L2@@F1', 0, ['1']),
+                           ('L2@@F1', 2, ['3'])])
+
+    def test_sort_rows_merge_passes(self):
+        keys = ['L%d@@F%d' % (i % 3, i % 7) for i in range(40)]
+        rows = [(key, n, [str(n)]) for n, key in enumerate(keys)]
+        merge_width = table_merge.MERGE_WIDTH
+        table_merge.MERGE_WIDTH = 3
+        try:
+            for max_runs in (1, 2, 5):
+                self.assertEquals(
+                    list(sort_rows(iter(rows), chunk_rows=2,
+                                   max_runs=max_runs)),
+                    sorted(rows))
+        finally:
+            table_merge.MERGE_WIDTH = merge_width
+
+    def test_sparse_abundance(self):
+        abd = SparseAbundance()
+        abd.add_rows(['mg1', 'mg2'], iter([('K2', 0, ['0', '1.50']),
+                                           ('K1', 1, ['3', '0'])]))
+        abd.add_rows(['mg2', 'mg3'], iter([('K1', 0, ['0', '2.5']),
+                                           ('K3', 1, ['0', '0'])]))
+        self.assertEquals(list(abd.iter_rows(['mg1', 'mg2', 'mg3'])),
+                          [('K1', ['3', '0', '2.5']),
+                           ('K2', ['0', '1.50', '0']),
+                           ('K3', ['0', '0', '0'])])
+
+
+class Test_abundance_table_transpose(unittest.TestCase):
+    def test_abundance_table(self):
+        header = ['mgid', 'level1', 'level2', 'level3', 'function', 'id',
+                  'abundance\n']
+        rows = ['mgm2\tA\tB\t"C"\tF1\tK1\t3\n',
+                'mgm1\tA\tB\tC\tF1\tK2\t4\n',
+                'mgm2\tA\tB\tC\tF0\tK0\t1\n',
+                'mgm2\tA\tB\tC\tF1\tK3\t2\n']
+        subsys_abd = SubsystemAbundance(rows, header, 4)
+        subsystems, table, ids = abundance_table(subsys_abd)
+        self.assertEquals(subsystems, ['A@@B@@C@@F0', 'A@@B@@C@@F1'])
+        self.assertEquals(ids, ['K0', 'K3'])
+        mg2 = subsys_abd.mg_ids.index('mgm2')
+        self.assertEquals(table[:, mg2].tolist(), [1, 5])
+        self.assertEquals(table[:, 1 - mg2].tolist(), [0, 4])
+
+        # coarser levels are rolled up from the same parse
+        subsystems, table, ids = abundance_table(subsys_abd, 2)
+        self.assertEquals(subsystems, ['A@@B'])
+        self.assertEquals(ids, None)
+        self.assertEquals(table[:, mg2].tolist(), [6])
+
+
+class Test_filter_failed_screening(unittest.TestCase):
+    def setUp(self):
+        self.lines = ['@r1 desc', 'ACGT', '+', 'IIII', '',
+                      '@r2', 'GGCC', '+', 'HHHH',
+                      '@r3', 'TTAA', '+', 'JJJJ']
+
+    def test_iter_fastq(self):
+        self.assertEquals(list(iter_fastq(self.lines)),
+                          [('@r1 desc', 'ACGT', '+', 'IIII'),
+                           ('@r2', 'GGCC', '+', 'HHHH'),
+                           ('@r3', 'TTAA', '+', 'JJJJ')])
+
+    def test_truncated_record(self):
+        with self.assertRaises(ValueError) as cm:
+            list(iter_fastq(self.lines[:-1]))
+        self.assertIn('Truncated FASTQ record: @r3', str(cm.exception))
+
+    def test_write_filtered_fastq(self):
+        with tempfile.TemporaryFile('w+') as out_f:
+            counts = write_filtered_fastq(self.lines, set(['r2']), out_f,
+                                          batch_size=2)
+            out_f.seek(0)
+            self.assertEquals(counts, (2, 1))
+            self.assertEquals(out_f.read(), '@r1 desc\nACGT\n+\nIIII\n'
+                                            '@r3\nTTAA\n+\nJJJJ\n')
+
+    def test_hashed_id_set(self):
+        screen_ids = HashedIDSet(['r1', 'r3'])
+        self.assertEquals(list(screen_ids.contains_many(['r1', 'r2', 'r3'])),
+                          [True, False, True])
+        self.assertTrue(screen_ids.verify())
+        # IDs in the set must all be looked up
+        screen_ids = HashedIDSet(['r1', 'r4'])
+        screen_ids.contains_many(['r1', 'r2', 'r3'])
+        self.assertRaises(ValueError, screen_ids.verify)
+
+    def test_hash_collision(self):
+        # reads r2 and r3 share a hash
+        class CollidingIDSet(HashedIDSet):
+            def _hashes(self, ids):
+                return np.array([int(seq_id[1:]) // 2 for seq_id in ids],
+                                dtype=np.uint64)
+
+        screen_ids = CollidingIDSet(['r1', 'r2'])
+        self.assertEquals(list(screen_ids.contains_many(['r1', 'r2', 'r3'])),
+                          [True, True, True])
+        self.assertFalse(screen_ids.verify())
+        # only the IDs of the colliding hashes are kept
+        screen_ids.resolve(['r1', 'r2'])
+        self.assertEquals(screen_ids.exact, {'r2': 0})
+        self.assertEquals(list(screen_ids.contains_many(['r1', 'r2', 'r3'])),
+                          [True, True, False])
+        self.assertTrue(screen_ids.verify())
+
+        out_dir = tempfile.mkdtemp()
+        try:
+            derep_fp = osp.join(out_dir, 'derep.fastq')
+            screen_fp = osp.join(out_dir, 'screen.fastq')
+            with open(derep_fp, 'w') as out_f:
+                out_f.write('\n'.join(self.lines) + '\n')
+            with open(screen_fp, 'w') as out_f:
+                out_f.write('\n'.join(self.lines[:9]) + '\n')
+
+            filter_failed_screening.HashedIDSet = CollidingIDSet
+            try:
+                args = Namespace(auth_key='', verbose=False, out_dir=out_dir,
+                                 derep_passed_fp=derep_fp,
+                                 screen_passed_fp=screen_fp)
+                filter_failed_screening.filter_metagenome_stream(
+                    'mgm1', args, '150', '299')
+            finally:
+                filter_failed_screening.HashedIDSet = HashedIDSet
+            with open(osp.join(out_dir, 'mgm1_screen_failed.fastq')) as in_f:
+                self.assertEquals(in_f.read(), '@r3\nTTAA\n+\nJJJJ\n')
+        finally:
+            shutil.rmtree(out_dir)
  
  
 if __name__ == '__main__':
@@ -0,0 +1,214 @@
+"""
+This module provides asyncio counterparts to the blocking API functions in
+mgr_api.api and mgr_api.m5nr, for use from within a running event loop.
+
+Each call is executed on a pooled MGRASTClient in a dedicated worker thread
+pool, and a semaphore bounds the number of API calls in flight at once. The
+functions take the same arguments and raise the same exceptions
+(MGRASTException, MGRASTAuthenticationException) as their blocking
+versions. Cancelling a call releases its slot immediately and discards the
+response; a request already on the wire is allowed to finish in its thread.
+
+NOTE: This module requires Python 3.5 or later.
+
+Usage:
+    from mgr_api import aio
+
+    async def fetch(mg_ids, auth_key):
+        client = aio.AsyncMGRASTClient(max_concurrency=16)
+        return await aio.gather(*[client.sequence_annotation(mg, 'KEGG',
+                                                             'function',
+                                                             auth_key)
+                                  for mg in mg_ids])
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import threading
+
+from mgr_api import api
+
+
+class AsyncMGRASTClient(object):
+    """
+    An asyncio interface to the MG-RAST API.
+
+    :type client: mgr_api.api.MGRASTClient
+    :param client: The blocking client used to make requests. The shared
+                   default client is used if not specified.
+    :type max_concurrency: int
+    :param max_concurrency: The maximum number of API calls in flight at any
+                            one time across all coroutines using this client.
+    """
+    def __init__(self, client=None, max_concurrency=8):
+        self.client = client if client is not None else api.default_client()
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # created on first use so that it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def close(self):
+        """
+        Shut down the worker threads used by this client.
+        """
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args, **kwargs):
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor,
+                                              functools.partial(func, *args,
+                                                                **kwargs))
+
+    async def mgrast_request(self, method, item_id=None, params=None,
+                             auth_key=None, debug=False):
+        """
+        Makes an MG-RAST API call. See mgr_api.api.mgrast_request
+        """
+        return await self._run(self.client.request, method, item_id, params,
+                               auth_key, debug)
+
+    async def project_metagenomes(self, project_id, match=None, auth_key=None):
+        """
+        Given an MG-RAST project ID, download a list of all metagenome IDs
+        belonging to that project. See mgr_api.api.project_metagenomes
+
+        Metagenome metadata is requested concurrently; the first failed
+        request cancels the rest and is raised.
+        """
+        project_id = api.id_check('mgp', project_id)
+        if match is None:
+            match = ['']
+
+        r = await self.mgrast_request('project', project_id,
+                                      {'verbosity': 'full'}, auth_key)
+        project_data = json.loads(r.text)
+        mg_ids = [mg[0] for mg in project_data['metagenomes']]
+
+        responses = await gather(*[self.mgrast_request('metagenome', mg_id,
+                                                       {'verbosity': 'minimal'},
+                                                       auth_key)
+                                   for mg_id in mg_ids])
+        metagenomes = {}
+        for mg_id, r in zip(mg_ids, responses):
+            mg_info = json.loads(r.text)
+            # find maximally matching name
+            for m in sorted(match, key=lambda x: len(x), reverse=True):
+                if m in mg_info['name']:
+                    metagenomes[mg_id] = mg_info['name']
+
+        return metagenomes
+
+    async def _annotation(self, method, mg_id, database, dtype, auth_key,
+                          params):
+        mg_id = api.id_check('mgm', mg_id)
+        params = dict(params, source=database, type=dtype)
+        r = await self.mgrast_request(method, mg_id, params, auth_key=auth_key)
+        return api.parse_annotation(r.text)
+
+    async def sequence_annotation(self, mg_id, database, dtype, auth_key,
+                                  **params):
+        """
+        Retrieve annotated sequence data for a single metagenome against a
+        database. See mgr_api.api.sequence_annotation
+        """
+        return await self._annotation('annotation/sequence', mg_id, database,
+                                      dtype, auth_key, params)
+
+    async def similarity_annotation(self, mg_id, database, dtype, auth_key,
+                                    **params):
+        """
+        Retrieve annotated similarity data for a single metagenome against a
+        database. See mgr_api.api.similarity_annotation
+        """
+        return await self._annotation('annotation/similarity', mg_id,
+                                      database, dtype, auth_key, params)
+
+    async def md5(self, checksum_id, **kwargs):
+        """
+        Return annotation or sequence information for the specified M5NR ID.
+        See mgr_api.m5nr.md5
+        """
+        req = await self.mgrast_request('m5nr/md5', checksum_id, params=kwargs)
+        return json.loads(req.text)
+
+    async def ontology_annotations(self, database='KO', **kwargs):
+        """
+        Download a functional hierarchy for the specified database in m5nr.
+        See mgr_api.m5nr.ontology_annotations
+        """
+        kwargs.update({'source': database})
+        req = await self.mgrast_request('m5nr/ontology', '', params=kwargs)
+        return {entry['accession']: entry
+                for entry in json.loads(req.text)['data']}
+
+
+async def gather(*coros):
+    """
+    Like asyncio.gather, but the first exception raised cancels all the
+    remaining awaitables before it is propagated.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client():
+    """
+    Return the shared AsyncMGRASTClient used by the module-level functions,
+    creating it on first use.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = AsyncMGRASTClient()
+        return _default_client
+
+def set_default_client(client):
+    """
+    Replace the shared AsyncMGRASTClient used by the module-level functions,
+    e.g. to change the concurrency limit.
+    """
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
+
+
+async def mgrast_request(method, item_id=None, params=None, auth_key=None,
+                         debug=False):
+    return await default_client().mgrast_request(method, item_id, params,
+                                                 auth_key, debug)
+
+async def project_metagenomes(project_id, match=None, auth_key=None):
+    return await default_client().project_metagenomes(project_id, match,
+                                                      auth_key)
+
+async def sequence_annotation(mg_id, database, dtype, auth_key, **params):
+    return await default_client().sequence_annotation(mg_id, database, dtype,
+                                                      auth_key, **params)
+
+async def similarity_annotation(mg_id, database, dtype, auth_key, **params):
+    return await default_client().similarity_annotation(mg_id, database,
+                                                        dtype, auth_key,
+                                                        **params)
+
+async def md5(checksum_id, **kwargs):
+    return await default_client().md5(checksum_id, **kwargs)
+
+async def ontology_annotations(database='KO', **kwargs):
+    return await default_client().ontology_annotations(database, **kwargs)
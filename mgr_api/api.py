@@ -6,9 +6,20 @@ provided by the API. Value-added methods are elsewhere.
 from __future__ import absolute_import, division, print_function
 
 # standard library imports
+try:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+except ImportError:
+    # Python 2 without the futures backport: API calls are made sequentially
+    ThreadPoolExecutor = None
 import json
+import threading
+import time
 # third party imports
 import requests
+from requests.adapters import HTTPAdapter
+# local imports
+from mgr_api.cache import ResponseCache
+from mgr_api.ratelimit import RetryPolicy
 
 class MGRASTException(Exception):
     """
@@ -23,25 +34,179 @@ class MGRASTAuthenticationException(MGRASTException):
     """
     pass
 
-def mgrast_request(method, item_id=None, params=None, auth_key=None, debug=False):
+API_URL = 'http://api.metagenomics.anl.gov/1'
+
+# seconds to wait for a connection and between bytes received, respectively
+DEFAULT_TIMEOUT = (30, 300)
+DEFAULT_RETRY = RetryPolicy()
+
+
+class MGRASTClient(object):
     """
-    Makes an MG-RAST API call
+    A reusable connection to the MG-RAST API.
+
+    All requests are sent through a single requests.Session backed by a pool
+    of keep-alive connections, so repeated calls against the API (e.g. one
+    call per metagenome in a project) reuse open connections instead of
+    paying for a new TCP connection each time.
+
+    :type base_url: string
+    :param base_url: The root URL of the API, including the version.
+    :type auth_key: string
+    :param auth_key: Default MG-RAST web authentication key, used for any
+                     request that does not supply its own.
+    :type pool_size: int
+    :param pool_size: The maximum number of connections kept open to the API.
+                      This should be at least the number of threads expected
+                      to use the client concurrently.
+    :type cache: mgr_api.cache.ResponseCache
+    :param cache: Optional on-disk cache consulted before, and updated after,
+                  each successful API call.
+    :type timeout: float or tuple
+    :param timeout: Seconds to wait for the server to connect and to send
+                    data, as a single value or a (connect, read) tuple.
+    :type retry: mgr_api.ratelimit.RetryPolicy
+    :param retry: How to retry timeouts, transient HTTP errors and
+                  (optionally) connection errors. None disables retries.
+                  Authentication and other MG-RAST errors are never retried.
+    :type rate_limiter: mgr_api.ratelimit.RateLimiter
+    :param rate_limiter: Optional token bucket pacing the requests made by
+                         all threads using this client. Requests are not
+                         paced by default.
     """
-    auth = {'auth': auth_key} if auth_key else {}
-    item_id = '' if item_id is None else '/'+item_id
-    join_mult = lambda item: '&'.join(['{}={}'.format(item[0],entry) for entry in item[1]])
-    params = '?' + '&'.join(['='.join(item) if not isinstance(item[1],list) else join_mult(item) for item in params.items()]) if params else ''
-    url = 'http://api.metagenomics.anl.gov/1/{method}{ID}{params}'
-    fURL = url.format(method=method, ID=item_id, params=params)
+    def __init__(self, base_url=API_URL, auth_key=None, pool_size=10,
+                 cache=None, timeout=DEFAULT_TIMEOUT, retry=DEFAULT_RETRY,
+                 rate_limiter=None):
+        self.base_url = base_url.rstrip('/')
+        self.auth_key = auth_key
+        self.pool_size = pool_size
+        self.cache = cache
+        self.timeout = timeout
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    if debug:
-        print(fURL)
-        return
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close all pooled connections held by this client.
+        """
+        self.session.close()
+
+    def url(self, method, item_id=None, params=None):
+        """
+        Build the full URL for an API call.
+        """
+        item_id = '' if item_id is None else '/'+item_id
+        join_mult = lambda item: '&'.join(['{}={}'.format(item[0],entry) for entry in item[1]])
+        params = '?' + '&'.join(['='.join(item) if not isinstance(item[1],list) else join_mult(item) for item in params.items()]) if params else ''
+        return '{base}/{method}{ID}{params}'.format(base=self.base_url,
+                                                   method=method, ID=item_id,
+                                                   params=params)
+
+    def request(self, method, item_id=None, params=None, auth_key=None,
+                debug=False, stream=False, headers=None, data=None):
+        """
+        Makes an MG-RAST API call
+
+        If stream is True the response body is not read up front and must be
+        consumed with resp.iter_content() or resp.iter_lines(); streamed
+        responses are never cached. Any additional HTTP headers (e.g. Range)
+        may be given in headers. If data is given, the call is sent as a POST
+        request with data as its JSON-encoded body (used by API methods that
+        accept many IDs at once) and is not cached.
+        """
+        auth_key = auth_key if auth_key else self.auth_key
+        req_headers = {'auth': auth_key} if auth_key else {}
+        if headers:
+            req_headers.update(headers)
+        fURL = self.url(method, item_id, params)
+
+        if debug:
+            print(fURL)
+            return
 
-    # submit request
-    resp = requests.get(fURL, headers=auth)
+        cache_key = None
+        if (self.cache is not None and not stream and not headers and
+                data is None and self.cache.cacheable(method, params)):
+            cache_key = self.cache.key(method, item_id, params, auth_key)
+            resp = self.cache.get(cache_key)
+            if resp is not None:
+                return resp
 
-    if resp.headers['content-type'].startswith('application/json'):
+        # submit request
+        if data is None:
+            resp = self._send('GET', fURL, req_headers, stream)
+        else:
+            resp = self._send('POST', fURL, req_headers, stream,
+                              json.dumps(data))
+        check_response(resp)
+
+        if cache_key is not None and resp.status_code == 200:
+            self.cache.set(cache_key, method, resp, params)
+        return resp
+
+    def _send(self, verb, url, headers, stream, body=None):
+        """
+        Send an HTTP request, pacing it through the rate limiter and retrying
+        transient failures according to the retry policy.
+        """
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                resp = self.session.request(verb, url, headers=headers,
+                                            data=body, stream=stream,
+                                            timeout=self.timeout)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                resp, error = None, ex
+
+            retry = self.retry
+            if error is None:
+                retryable = (retry is not None and
+                             resp.status_code in retry.statuses)
+                if not retryable:
+                    if limiter is not None:
+                        limiter.success()
+                    return resp
+            else:
+                retryable = retry is not None and (
+                    retry.connection_errors or
+                    not isinstance(error, requests.ConnectionError))
+
+            if limiter is not None:
+                limiter.failure()
+            if not retryable or attempt >= retry.retries:
+                if error is not None:
+                    raise error
+                return resp
+
+            retry_after = None
+            if resp is not None:
+                retry_after = resp.headers.get('Retry-After')
+                resp.close()
+            time.sleep(retry.delay(attempt, retry_after))
+            attempt += 1
+
+
+def check_response(resp):
+    """
+    Raise the appropriate MGRASTException if the API returned an error
+    message in place of the requested data.
+    """
+    if resp.headers.get('content-type', '').startswith('application/json'):
         text = json.loads(resp.text)
         if 'ERROR' in text:
             if ('insufficient permissions' in text['ERROR'] or
@@ -49,7 +214,53 @@ def mgrast_request(method, item_id=None, params=None, auth_key=None, debug=False
                 raise MGRASTAuthenticationException(text['ERROR'])
             raise MGRASTException(text['ERROR'])
 
-    return resp
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client():
+    """
+    Return the shared MGRASTClient used by the module-level API functions,
+    creating it on first use.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = MGRASTClient()
+        return _default_client
+
+def set_default_client(client):
+    """
+    Replace the shared MGRASTClient used by the module-level API functions,
+    e.g. to change the pool size, base URL or default authentication key, or
+    to pace requests with a mgr_api.ratelimit.RateLimiter.
+    The previous client, if any, is closed.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is not None and _default_client is not client:
+            _default_client.close()
+        _default_client = client
+
+def enable_cache(cache_dir, **kwargs):
+    """
+    Turn on the persistent response cache for the shared default client.
+    Keyword arguments are passed on to mgr_api.cache.ResponseCache.
+
+    :rtype: mgr_api.cache.ResponseCache
+    :return: The cache, e.g. for inspecting cache.stats()
+    """
+    client = default_client()
+    client.cache = ResponseCache(cache_dir, **kwargs)
+    return client.cache
+
+def mgrast_request(method, item_id=None, params=None, auth_key=None, debug=False,
+                   stream=False, headers=None, data=None):
+    """
+    Makes an MG-RAST API call through the shared default client.
+    """
+    return default_client().request(method, item_id, params, auth_key, debug,
+                                    stream, headers, data)
 
 def id_check(prefix, ID):
     """
@@ -61,10 +272,38 @@ def id_check(prefix, ID):
         ID = prefix + ID
     return ID
 
-def project_metagenomes(project_id, match=None, auth_key=None):
+def map_concurrent(func, items, max_workers=8):
+    """
+    Apply func to each item using at most max_workers threads and return the
+    results in input order. The first exception raised by any call (e.g. an
+    MGRASTAuthenticationException) cancels all calls that have not yet
+    started and is re-raised immediately. Calls are made sequentially if
+    concurrent.futures is unavailable.
+    """
+    items = list(items)
+    if ThreadPoolExecutor is None or max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+
+def project_metagenomes(project_id, match=None, auth_key=None, max_workers=8):
     """
     Given an MG-RAST project ID, download a list of all metagenome IDs belonging
     to that project.
+
+    Metagenome metadata is requested concurrently with at most max_workers
+    requests in flight at a time. The first failed request (e.g. an
+    authentication error) aborts the remaining requests and is raised.
     """
     project_id = id_check('mgp', project_id)
     if match is None:
@@ -73,11 +312,16 @@ def project_metagenomes(project_id, match=None, auth_key=None):
     r = mgrast_request('project', project_id, {'verbosity':'full'}, auth_key)
     project_data = json.loads(r.text)
 
+    def metagenome_info(mg_id):
+        r = mgrast_request('metagenome', mg_id, {'verbosity': 'minimal'}, auth_key)
+        return json.loads(r.text)
+
+    mg_ids = [mg[0] for mg in project_data['metagenomes']]
+    mg_infos = map_concurrent(metagenome_info, mg_ids, max_workers)
+
     metagenomes = {}
 
-    for mg_id in [mg[0] for mg in project_data['metagenomes']]:
-        r = mgrast_request('metagenome', mg_id, {'verbosity': 'minimal'}, auth_key)
-        mg_info = json.loads(r.text)
+    for mg_id, mg_info in zip(mg_ids, mg_infos):
         # find maximally matching name
         for m in sorted(match, key=lambda x: len(x), reverse=True):
             if m in mg_info['name']:
@@ -86,6 +330,40 @@ def project_metagenomes(project_id, match=None, auth_key=None):
     return metagenomes
 
 
+def parse_annotation(text):
+    """
+    Split the tabular body of an annotation download into rows of fields,
+    dropping the header line and the download trailer.
+    """
+    if text.rfind('Download complete') == 0:
+        raise Exception('Data download incomplete')
+    return [x.split('\t') for x in text.split('\n')[1:-2]]
+
+
+def iter_annotation(resp, chunk_size=64*1024):
+    """
+    Lazily split a streamed annotation download into rows of fields,
+    skipping the header line and stopping at the download trailer. Only one
+    line of the response is held in memory at a time.
+
+    :raises MGRASTException: If the stream ends before the 'Download
+                             complete' trailer, i.e. the data was truncated.
+    """
+    try:
+        # without a charset in the response headers, iter_lines yields bytes
+        resp.encoding = resp.encoding or 'utf-8'
+        lines = resp.iter_lines(chunk_size=chunk_size, decode_unicode=True)
+        for i, line in enumerate(lines):
+            if i == 0:
+                continue
+            if line.startswith('Download complete'):
+                return
+            yield line.split('\t')
+        raise MGRASTException('Data download incomplete')
+    finally:
+        resp.close()
+
+
 def sequence_annotation(mg_id, database, dtype, auth_key, **params):
     """
     Retrieve annotated sequence data for a single metagenome against a database.
@@ -104,12 +382,26 @@ def sequence_annotation(mg_id, database, dtype, auth_key, **params):
         params = {}
     params.update({'source': database, 'type': dtype})
     r = mgrast_request('annotation/sequence', mg_id, params, auth_key=auth_key)
-    if r.text.rfind('Download complete') == 0:
-        raise Exception('Data download incomplete')
-    return [x.split('\t') for x in r.text.split('\n')[1:-2]]
+    return parse_annotation(r.text)
+
 
+def iter_sequence_annotation(mg_id, database, dtype, auth_key, **params):
+    """
+    Streaming version of sequence_annotation(). Rows are yielded as they
+    arrive from MG-RAST instead of being collected into a list, so memory use
+    stays constant regardless of the size of the download.
 
-def similarity_annotation(mg_id, database, dtype, auth_key, **params):
+    :raises MGRASTException: If the download ends before it is complete.
+    """
+    mg_id = id_check('mgm', mg_id)
+    params.update({'source': database, 'type': dtype})
+    r = mgrast_request('annotation/sequence', mg_id, params, auth_key=auth_key,
+                       stream=True)
+    return iter_annotation(r)
+
+
+def similarity_annotation(mg_id, database, dtype, auth_key, columnar=False,
+                          **params):
     """
     Retrieve annotated similarity data for a single metagenome against a
     database.
@@ -119,30 +411,118 @@ def similarity_annotation(mg_id, database, dtype, auth_key, **params):
     The returned tabular data is in the format:
     sequence id, m5nr id (md5sum), list of similarity-related scores
 
+    :type columnar: bool
+    :param columnar: If True, stream the download into a
+                     mgr_api.similarity.SimilarityBatch with typed NumPy
+                     arrays for the scores (requires NumPy).
     :@return: A list of result rows split into lists containing the above
-              tabular data.
+              tabular data, or a SimilarityBatch if columnar is True.
     """
+    if columnar:
+        # NumPy is only required for the columnar representation
+        from mgr_api.similarity import SimilarityBatch
+        return SimilarityBatch.from_rows(
+            iter_similarity_annotation(mg_id, database, dtype, auth_key,
+                                       **params))
+
     mg_id = id_check('mgm', mg_id)
     if params is None:
         params = {}
     params.update({'source': database, 'type': dtype})
     r = mgrast_request('annotation/similarity', mg_id, params, auth_key=auth_key)
-    if r.text.rfind('Download complete') == 0:
-        raise Exception('Data download incomplete')
-    return [x.split('\t') for x in r.text.split('\n')[1:-2]]
+    return parse_annotation(r.text)
 
 
-def download_metagenome_data(metagenomes, func, database='KEGG', dtype='function', params=None, auth_key=None):
+def iter_similarity_annotation(mg_id, database, dtype, auth_key, **params):
     """
-    Apply an MG-RAST API 'download' function to a list of metagenome IDs and return the data
-    as a list of results for each given metagenome.
+    Streaming version of similarity_annotation(). Rows are yielded as they
+    arrive from MG-RAST instead of being collected into a list.
+
+    :raises MGRASTException: If the download ends before it is complete.
+    """
+    mg_id = id_check('mgm', mg_id)
+    params.update({'source': database, 'type': dtype})
+    r = mgrast_request('annotation/similarity', mg_id, params,
+                       auth_key=auth_key, stream=True)
+    return iter_annotation(r)
+
+
+def iter_metagenome_data(metagenomes, func, database='KEGG', dtype='function',
+                         params=None, auth_key=None, max_workers=4,
+                         ordered=True, errors=None):
+    """
+    Apply an MG-RAST API 'download' function to a list of metagenome IDs using
+    up to max_workers concurrent downloads, yielding (mg_id, rows) for each
+    metagenome. Any params are passed on to func as keyword arguments.
+
+    :type ordered: bool
+    :param ordered: If True, results are yielded in the order of the input
+                    metagenomes. Otherwise each result is yielded as soon as
+                    its download completes.
+    :type errors: dict
+    :param errors: If given, a failed download is recorded here as
+                   {mg_id: exception} and the remaining downloads continue.
+                   Otherwise the first failure aborts the batch and is raised.
+                   An MGRASTAuthenticationException always aborts the batch.
     """
-    results = []
     params = {} if params is None else params
-    for mg in metagenomes:
-        results.extend(func(mg, database, dtype, auth_key))
-    return results
+    fetch = lambda mg: func(mg, database, dtype, auth_key, **params)
 
+    if ThreadPoolExecutor is None:
+        # no thread pool: download each metagenome as its result is needed
+        for mg in metagenomes:
+            for result in _collect(mg, lambda: fetch(mg), errors):
+                yield result
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    futures = [(executor.submit(fetch, mg), mg) for mg in metagenomes]
+    mg_ids = {future: mg for future, mg in futures}
+    try:
+        if ordered:
+            done = (future for future, _ in futures)
+        else:
+            done = as_completed(mg_ids)
+        for future in done:
+            for result in _collect(mg_ids[future], future.result, errors):
+                yield result
+    finally:
+        for future, _ in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
 
-    
 
+def _collect(mg, result, errors):
+    """
+    Yield (mg, rows) from calling result(), or record a failure in errors as
+    described in iter_metagenome_data().
+    """
+    try:
+        rows = result()
+    except MGRASTAuthenticationException:
+        raise
+    except Exception as ex:
+        if errors is None:
+            raise
+        errors[mg] = ex
+        return
+    yield mg, rows
+
+
+def download_metagenome_data(metagenomes, func, database='KEGG', dtype='function',
+                             params=None, auth_key=None, max_workers=1,
+                             errors=None):
+    """
+    Apply an MG-RAST API 'download' function to a list of metagenome IDs and return the data
+    as a list of results for each given metagenome.
+
+    Downloads run concurrently when max_workers is greater than 1; results are
+    always returned in input order. See iter_metagenome_data() for params and
+    errors.
+    """
+    results = []
+    for _, rows in iter_metagenome_data(metagenomes, func, database, dtype,
+                                        params, auth_key, max_workers,
+                                        ordered=True, errors=errors):
+        results.extend(rows)
+    return results
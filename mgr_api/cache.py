@@ -0,0 +1,254 @@
+"""
+This module implements an opt-in, persistent on-disk cache for MG-RAST API
+responses. Response bodies are stored as individual files under the cache
+directory while an SQLite index tracks their size, age and last use so that
+entries can be expired per endpoint and evicted least-recently-used first
+once the cache grows past its byte budget.
+
+Usage:
+    from mgr_api import api
+    api.enable_cache('~/.cache/mgrast')
+"""
+from __future__ import absolute_import, division, print_function
+
+# standard library imports
+import hashlib
+import json
+import os, os.path as osp
+import sqlite3
+import tempfile
+import threading
+import time
+# third party imports
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+# local imports
+from mgr_api.util import replace
+
+# TTL value meaning an entry never expires
+FOREVER = None
+
+DAY = 24 * 60 * 60
+
+# Default time-to-live (seconds) for each API method, matched on the longest
+# prefix of the method name. Calls with a 'file' parameter are matched as
+# '<method>/file': downloads of finished pipeline stage files never change,
+# so they are kept until evicted, while the listing of a metagenome's stage
+# files can change as long as it is still being processed.
+DEFAULT_TTLS = {
+    'download': DAY,
+    'download/file': FOREVER,
+    'annotation': 7 * DAY,
+    'm5nr': 30 * DAY,
+    'matrix': DAY,
+    'metagenome': DAY,
+    'project': DAY,
+}
+
+_TRANSPORT_HEADERS = ('content-encoding', 'content-length',
+                      'transfer-encoding', 'connection', 'keep-alive')
+
+
+class ResponseCache(object):
+    """
+    A size-bounded, on-disk cache of MG-RAST API responses.
+
+    :type cache_dir: string
+    :param cache_dir: Directory holding the cached bodies and the index.
+    :type max_bytes: int
+    :param max_bytes: The total size of cached bodies to keep. Least
+                      recently used entries are evicted beyond this.
+    :type ttls: dict
+    :param ttls: Time-to-live in seconds keyed by API method (prefix). A TTL
+                 of FOREVER (None) never expires, a TTL of 0 is not cached.
+                 Entries are merged over DEFAULT_TTLS.
+    :type default_ttl: int
+    :param default_ttl: TTL for methods not matched in ttls.
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3, ttls=None,
+                 default_ttl=DAY):
+        self.cache_dir = osp.abspath(osp.expanduser(cache_dir))
+        if not osp.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(osp.join(self.cache_dir, 'index.sqlite'),
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, url TEXT, status INTEGER, '
+                         'headers TEXT, size INTEGER, created REAL, '
+                         'accessed REAL, expires REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed '
+                         'ON entries (accessed)')
+        self._db.commit()
+
+    def key(self, method, item_id=None, params=None, auth_key=None):
+        """
+        Return the cache key for an API call. The authentication key is
+        hashed so that private responses are only shared between callers
+        using the same key, without storing the key itself.
+        """
+        auth_id = (hashlib.sha256(auth_key.encode('utf-8')).hexdigest()
+                   if auth_key else '')
+        params = {k: v if isinstance(v, list) else [v]
+                  for k, v in (params or {}).items()}
+        ident = json.dumps([method, item_id or '', params, auth_id],
+                           sort_keys=True)
+        return hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+    def ttl(self, method, params=None):
+        """
+        Return the time-to-live for responses to the given API method and
+        parameters.
+        """
+        if params and 'file' in params:
+            method += '/file'
+        matches = [m for m in self.ttls if method.startswith(m)]
+        if not matches:
+            return self.default_ttl
+        return self.ttls[max(matches, key=len)]
+
+    def cacheable(self, method, params=None):
+        return self.ttl(method, params) != 0
+
+    def _body_path(self, key):
+        return osp.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """
+        Return the cached requests.Response for key, or None if there is no
+        unexpired entry.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT url, status, headers, expires '
+                                   'FROM entries WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is not None and row[3] is not None and row[3] < now:
+                self._remove(key)
+                row = None
+            if row is not None:
+                try:
+                    with open(self._body_path(key), 'rb') as body_f:
+                        body = body_f.read()
+                except (IOError, OSError):
+                    self._remove(key)
+                    row = None
+            if row is None:
+                self.misses += 1
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                             (now, key))
+            self._db.commit()
+            self.hits += 1
+
+        resp = requests.Response()
+        resp.url = row[0]
+        resp.status_code = row[1]
+        resp.headers = CaseInsensitiveDict(json.loads(row[2]))
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp._content = body
+        return resp
+
+    def set(self, key, method, resp, params=None):
+        """
+        Store a successful response to an API call under key, evicting the
+        least recently used entries if the cache grows beyond max_bytes.
+        """
+        ttl = self.ttl(method, params)
+        body = resp.content
+        if ttl == 0 or len(body) > self.max_bytes:
+            return
+
+        body_fp = self._body_path(key)
+        if not osp.isdir(osp.dirname(body_fp)):
+            try:
+                os.makedirs(osp.dirname(body_fp))
+            except OSError:
+                if not osp.isdir(osp.dirname(body_fp)):
+                    raise
+        # write atomically so readers never see a partial body
+        fd, tmp_fp = tempfile.mkstemp(dir=osp.dirname(body_fp))
+        with os.fdopen(fd, 'wb') as tmp_f:
+            tmp_f.write(body)
+        replace(tmp_fp, body_fp)
+
+        # the stored body is already decoded, drop headers describing the wire
+        headers = {k: v for k, v in resp.headers.items()
+                   if k.lower() not in _TRANSPORT_HEADERS}
+        now = time.time()
+        expires = None if ttl is FOREVER else now + ttl
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, resp.url, resp.status_code,
+                              json.dumps(headers), len(body), now,
+                              now, expires))
+            self.stores += 1
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) '
+                                 'FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute('SELECT key, size FROM entries '
+                                          'ORDER BY accessed').fetchall():
+            self._remove(key)
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _remove(self, key):
+        self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        try:
+            os.remove(self._body_path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        with self._lock:
+            for (key,) in self._db.execute('SELECT key FROM entries').fetchall():
+                self._remove(key)
+            self._db.commit()
+
+    def size(self):
+        """
+        Return the total size in bytes of the cached response bodies.
+        """
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) '
+                                    'FROM entries').fetchone()[0]
+
+    def stats(self):
+        """
+        Return a dictionary of cache usage statistics: hits, misses, stores,
+        evictions, the number of entries and their total size in bytes.
+        """
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), '
+                                             'COALESCE(SUM(size), 0) '
+                                             'FROM entries').fetchone()
+        return {'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'evictions': self.evictions,
+                'entries': entries, 'bytes': size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
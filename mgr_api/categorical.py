@@ -0,0 +1,58 @@
+"""
+This module implements a compact column of repeated strings (e.g. md5s,
+annotations or table keys) stored as integer codes, shared by the columnar
+similarity results and the binary abundance tables.
+"""
+from __future__ import absolute_import, division, print_function
+
+# standard library imports
+from array import array
+# third party imports
+import numpy as np
+
+
+class Categorical(object):
+    """
+    A column of repeated strings stored as integer codes into an array of
+    the distinct values (categories).
+    """
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.categories[self.codes[idx]]
+        return Categorical(self.codes[idx], self.categories)
+
+    def values(self):
+        """
+        Return the decoded column as an array of strings.
+        """
+        return self.categories[self.codes]
+
+
+class CategoricalBuilder(object):
+    """
+    Build a Categorical column one value at a time, assigning each distinct
+    value a code in order of first appearance.
+    """
+    def __init__(self):
+        self.index = {}
+        self.codes = array('i')
+
+    def append(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.index)
+        self.codes.append(code)
+
+    def build(self):
+        categories = np.empty(len(self.index), dtype=object)
+        for value, code in self.index.items():
+            categories[code] = value
+        return Categorical(np.frombuffer(self.codes, dtype=np.intc),
+                           categories)
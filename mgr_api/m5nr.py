@@ -6,6 +6,7 @@ organism, and sequence.
 See http://api.metagenomics.anl.gov//api.html#m5nr for full details and
 descriptions.
 """
+from collections import OrderedDict
 import json
 from mgr_api import api
 
@@ -44,4 +45,43 @@ def md5(checksum_id, **kwargs):
         kwargs = {}
         
     req = api.mgrast_request('m5nr/md5', checksum_id, params=kwargs)
-    return json.loads(req.text)
\ No newline at end of file
+    return json.loads(req.text)
+
+def md5_bulk(checksum_ids, batch_size=500, max_workers=4, **kwargs):
+    """
+    Resolve many M5NR IDs at once. The IDs are deduplicated and sent in
+    batches of batch_size through the API's POST form, which accepts a list
+    of IDs per call. Every page of results is retrieved for each batch and
+    up to max_workers batches are requested concurrently.
+
+    :type checksum_ids: iterable
+    :param checksum_ids: M5NR IDs (md5 checksums), duplicates allowed
+    :type kwargs: dict
+    :param kwargs: Optional arguments to the API call, as for md5(), e.g.
+                   source. limit sets the page size.
+    :rtype: dict
+    :return: The data entries (see md5()) for each distinct M5NR ID, keyed by
+             ID. IDs with no matching entries map to an empty list.
+    """
+    unique_ids = list(OrderedDict.fromkeys(checksum_ids))
+    batches = [unique_ids[i:i+batch_size]
+               for i in range(0, len(unique_ids), batch_size)]
+    limit = int(kwargs.pop('limit', 1000))
+
+    def resolve(batch):
+        entries = []
+        while True:
+            body = dict(kwargs, data=batch, limit=limit, offset=len(entries))
+            page = json.loads(api.mgrast_request('m5nr/md5', data=body).text)
+            entries.extend(page['data'])
+            total = page.get('total_count')
+            if (not page['data'] or
+                    (total is not None and len(entries) >= int(total)) or
+                    (total is None and len(page['data']) < limit)):
+                return entries
+
+    results = OrderedDict((checksum, []) for checksum in unique_ids)
+    for entries in api.map_concurrent(resolve, batches, max_workers):
+        for entry in entries:
+            results.setdefault(entry['md5'], []).append(entry)
+    return results
@@ -0,0 +1,93 @@
+"""
+This module implements request pacing and retry policies for MG-RAST API
+calls: a thread-safe token bucket whose rate adapts to the observed error
+rate, and exponential backoff with jitter for transient failures.
+"""
+from __future__ import absolute_import, division, print_function
+
+# standard library imports
+import random
+import threading
+import time
+
+# HTTP statuses indicating a transient server-side condition worth retrying
+RETRY_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+
+class RateLimiter(object):
+    """
+    A token bucket shared by all threads using an MGRASTClient.
+
+    Requests are paced at `rate` per second with bursts of up to `burst`
+    requests. The rate adapts to the server: every failed (throttled,
+    errored or timed out) request multiplies the rate by `decrease`, down to
+    `min_rate`, while every successful request adds `increase` back, up to
+    the `max_rate` it started at.
+    """
+    def __init__(self, rate=10.0, burst=None, min_rate=0.5, decrease=0.5,
+                 increase=0.1):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.min_rate = float(min_rate)
+        self.decrease = decrease
+        self.increase = increase
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failure(self):
+        with self._lock:
+            self._refill(time.time())
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter for retryable failures: read
+    timeouts, the HTTP statuses in `statuses` and, if `connection_errors`
+    is True, failures to connect to the server. Connection errors are not
+    retried by default so that an unreachable host fails fast. The delay
+    before retry n (starting at 0) is a random time up to
+    min(max_backoff, backoff * 2**n) seconds, or the server's Retry-After
+    value if it is longer.
+    """
+    def __init__(self, retries=4, backoff=1.0, max_backoff=60.0,
+                 statuses=RETRY_STATUSES, connection_errors=False):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.connection_errors = connection_errors
+
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        try:
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        except (TypeError, ValueError):
+            pass
+        return delay
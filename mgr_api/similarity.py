@@ -0,0 +1,119 @@
+"""
+This module implements a columnar, typed representation of MG-RAST
+similarity annotation data (see api.similarity_annotation) backed by NumPy
+arrays, so that score thresholds can be applied to millions of hits at once
+rather than by re-parsing strings row by row.
+"""
+from __future__ import absolute_import, division, print_function
+
+# standard library imports
+from array import array
+# third party imports
+import numpy as np
+# local imports
+from mgr_api.categorical import Categorical, CategoricalBuilder
+
+# score columns of the annotation/similarity download, in order, following
+# the query ID and md5 columns and preceding the annotation column:
+# (name, array typecode, NumPy dtype)
+SCORE_FIELDS = [('identity', 'f', np.float32),
+                ('length', 'i', np.int32),
+                ('mismatches', 'i', np.int32),
+                ('gap_openings', 'i', np.int32),
+                ('q_start', 'i', np.int32),
+                ('q_end', 'i', np.int32),
+                ('s_start', 'i', np.int32),
+                ('s_end', 'i', np.int32),
+                ('evalue', 'd', np.float64),
+                ('bit_score', 'f', np.float32)]
+
+
+class SimilarityBatch(object):
+    """
+    Similarity annotation results stored by column. Query IDs, md5s and
+    annotations are Categorical columns, the similarity scores are typed
+    NumPy arrays accessible by name (see SCORE_FIELDS), e.g. batch['evalue'].
+    """
+    def __init__(self, query_id, md5, scores, annotation):
+        self.query_id = query_id
+        self.md5 = md5
+        self.scores = scores
+        self.annotation = annotation
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a batch from an iterable of split similarity rows, such as
+        the output of api.similarity_annotation or
+        api.iter_similarity_annotation. Rows are consumed one at a time and
+        only their encoded values are kept.
+        """
+        query_id = CategoricalBuilder()
+        md5 = CategoricalBuilder()
+        annotation = CategoricalBuilder()
+        scores = [array(tc) for _, tc, _ in SCORE_FIELDS]
+        score_range = range(len(SCORE_FIELDS))
+        converters = [float if tc in 'fd' else int for _, tc, _ in SCORE_FIELDS]
+
+        for row in rows:
+            query_id.append(row[0])
+            md5.append(row[1])
+            for i in score_range:
+                scores[i].append(converters[i](row[i + 2]))
+            annotation.append(row[12] if len(row) > 12 else '')
+
+        return cls(query_id.build(), md5.build(),
+                   {name: np.array(col, dtype=dtype)
+                    for (name, _, dtype), col in zip(SCORE_FIELDS, scores)},
+                   annotation.build())
+
+    def __len__(self):
+        return len(self.query_id)
+
+    def __getitem__(self, name):
+        return self.scores[name]
+
+    def mask(self, max_evalue=None, min_identity=None, min_length=None):
+        """
+        Return a boolean array selecting the hits that pass all the given
+        thresholds: e-value at most max_evalue, percent identity at least
+        min_identity and alignment length at least min_length.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if max_evalue is not None:
+            keep &= self.scores['evalue'] <= max_evalue
+        if min_identity is not None:
+            keep &= self.scores['identity'] >= min_identity
+        if min_length is not None:
+            keep &= self.scores['length'] >= min_length
+        return keep
+
+    def take(self, idx):
+        """
+        Return a new batch of the hits selected by a boolean mask or an
+        array of row indices.
+        """
+        return SimilarityBatch(self.query_id[idx], self.md5[idx],
+                               {name: col[idx]
+                                for name, col in self.scores.items()},
+                               self.annotation[idx])
+
+    def filter(self, max_evalue=None, min_identity=None, min_length=None):
+        """
+        Return a new batch containing only the hits that pass all the given
+        thresholds. See mask()
+        """
+        return self.take(self.mask(max_evalue, min_identity, min_length))
+
+    def rows(self):
+        """
+        Iterate over the hits as lists of strings in the original column
+        order.
+        """
+        query_ids = self.query_id.values()
+        md5s = self.md5.values()
+        annotations = self.annotation.values()
+        scores = [self.scores[name] for name, _, _ in SCORE_FIELDS]
+        for i in range(len(self)):
+            yield ([query_ids[i], md5s[i]] +
+                   [str(col[i]) for col in scores] + [annotations[i]])
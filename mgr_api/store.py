@@ -0,0 +1,187 @@
+"""
+This module implements a local, indexed store of M5NR annotation data for
+offline lookups. The store is an SQLite database populated once from
+m5nr.ontology_annotations and m5nr.md5 / m5nr.md5_bulk results, after which
+any number of short-lived jobs can look up functional hierarchy entries by
+accession, md5 or hierarchy level without contacting MG-RAST.
+
+Usage:
+    from mgr_api.store import M5NRStore
+
+    store = M5NRStore('m5nr.sqlite')
+    store.populate_ontology('KO')      # once
+    store.ontology('K00001')
+"""
+from __future__ import absolute_import, division, print_function
+
+# standard library imports
+import json
+import sqlite3
+# local imports
+from mgr_api import m5nr
+
+LEVELS = ('level1', 'level2', 'level3', 'level4')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ontology (
+    source TEXT, accession TEXT, level1 TEXT, level2 TEXT, level3 TEXT,
+    level4 TEXT, entry TEXT, PRIMARY KEY (source, accession));
+CREATE INDEX IF NOT EXISTS ontology_accession ON ontology (accession);
+CREATE INDEX IF NOT EXISTS ontology_level1 ON ontology (level1);
+CREATE INDEX IF NOT EXISTS ontology_level2 ON ontology (level2);
+CREATE INDEX IF NOT EXISTS ontology_level3 ON ontology (level3);
+CREATE INDEX IF NOT EXISTS ontology_level4 ON ontology (level4);
+CREATE TABLE IF NOT EXISTS md5 (
+    md5 TEXT, source TEXT, accession TEXT, entry TEXT);
+CREATE INDEX IF NOT EXISTS md5_md5 ON md5 (md5);
+CREATE INDEX IF NOT EXISTS md5_accession ON md5 (accession);
+CREATE TABLE IF NOT EXISTS md5_resolved (md5 TEXT PRIMARY KEY);
+"""
+
+
+class M5NRStore(object):
+    """
+    A local SQLite store of M5NR ontology and md5 annotation entries.
+
+    The database is opened, and created if necessary, on first use, so
+    constructing a store is free for jobs that end up not needing it.
+
+    :type path: string
+    :param path: Location of the SQLite database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_ontology(self, entries, source=None):
+        """
+        Store functional hierarchy entries, replacing any existing entries
+        with the same source and accession.
+
+        :type entries: dict or iterable
+        :param entries: The output of m5nr.ontology_annotations, or any
+                        iterable of its entry dictionaries.
+        :type source: string
+        :param source: The ontology source (e.g. KO, Subsystems), used when an
+                       entry does not specify its own.
+        """
+        if isinstance(entries, dict):
+            entries = entries.values()
+        rows = ((entry.get('source', source), entry['accession']) +
+                tuple(entry.get(lvl) for lvl in LEVELS) +
+                (json.dumps(entry),)
+                for entry in entries)
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO ontology '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def populate_ontology(self, database='KO', **kwargs):
+        """
+        Download the functional hierarchy for database from MG-RAST (see
+        m5nr.ontology_annotations) and add it to the store.
+        """
+        self.add_ontology(m5nr.ontology_annotations(database, **kwargs),
+                          database)
+
+    def add_md5(self, results):
+        """
+        Store md5 annotation entries. Every md5 in results is recorded as
+        resolved, even if it has no entries, so that md5() can distinguish
+        'no annotations' from 'never looked up'.
+
+        :type results: dict
+        :param results: The output of m5nr.md5_bulk ({md5: [entries]}) or a
+                        single m5nr.md5 response (with a 'data' list).
+        """
+        if 'data' in results and isinstance(results['data'], list):
+            grouped = {}
+            for entry in results['data']:
+                grouped.setdefault(entry['md5'], []).append(entry)
+            results = grouped
+
+        with self.db:
+            for checksum, entries in results.items():
+                self.db.execute('DELETE FROM md5 WHERE md5 = ?', (checksum,))
+                self.db.executemany('INSERT INTO md5 VALUES (?, ?, ?, ?)',
+                                    ((checksum, entry.get('source'),
+                                      entry.get('accession'),
+                                      json.dumps(entry))
+                                     for entry in entries))
+                self.db.execute('INSERT OR IGNORE INTO md5_resolved '
+                                'VALUES (?)', (checksum,))
+
+    def ontology(self, accession, source=None):
+        """
+        Return the functional hierarchy entry for an accession, or None if
+        it is not in the store.
+        """
+        query = 'SELECT entry FROM ontology WHERE accession = ?'
+        args = (accession,)
+        if source is not None:
+            query += ' AND source = ?'
+            args += (source,)
+        row = self.db.execute(query, args).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def by_level(self, level, name, source=None):
+        """
+        Return all functional hierarchy entries whose value at a hierarchy
+        level (1-4 or 'level1'...'level4') equals name.
+        """
+        if isinstance(level, int):
+            level = 'level{}'.format(level)
+        if level not in LEVELS:
+            raise ValueError("Unknown hierarchy level: {}".format(level))
+        query = 'SELECT entry FROM ontology WHERE {} = ?'.format(level)
+        args = (name,)
+        if source is not None:
+            query += ' AND source = ?'
+            args += (source,)
+        return [json.loads(row[0]) for row in self.db.execute(query, args)]
+
+    def md5(self, checksum, source=None):
+        """
+        Return the stored annotation entries for an md5 checksum, or None if
+        the checksum has never been added to the store.
+        """
+        resolved = self.db.execute('SELECT 1 FROM md5_resolved WHERE md5 = ?',
+                                   (checksum,)).fetchone()
+        if resolved is None:
+            return None
+        query = 'SELECT entry FROM md5 WHERE md5 = ?'
+        args = (checksum,)
+        if source is not None:
+            query += ' AND source = ?'
+            args += (source,)
+        return [json.loads(row[0]) for row in self.db.execute(query, args)]
+
+    def md5_ontology(self, checksum, source=None):
+        """
+        Return the functional hierarchy entries for the accessions annotated
+        to an md5 checksum.
+        """
+        query = ('SELECT DISTINCT o.entry FROM md5 m JOIN ontology o '
+                 'ON o.accession = m.accession WHERE m.md5 = ?')
+        args = (checksum,)
+        if source is not None:
+            query += ' AND o.source = ?'
+            args += (source,)
+        return [json.loads(row[0]) for row in self.db.execute(query, args)]
@@ -0,0 +1,273 @@
+"""
+This module implements a compact binary columnar format for abundance
+tables (a row per function, a column per sample), so that tables passed
+between the bin/ tools are not re-parsed from TSV at every step.
+
+A table is stored as a directory holding:
+
+    meta.json   the key column names, the sample IDs, for each key column
+                its distinct values (the key dictionary), and how whole
+                float abundances are written as text
+    keys.npy    the dictionary codes of the key columns (rows x key columns)
+    values.npy  the abundances as a typed array (rows x samples)
+
+The arrays are standard NumPy .npy files and are memory-mapped when read,
+so opening a table is cheap and only the rows and columns used are read.
+
+Usage:
+    from mgr_api import table
+
+    abd = table.read_tsv('merged_table.txt', n_key_columns=4)
+    table.write_table(abd, 'merged_table')
+    abd = table.read_table('merged_table')
+"""
+from __future__ import absolute_import, division, print_function
+
+# standard library imports
+import csv
+from functools import partial
+from itertools import islice
+import json
+import os, os.path as osp
+import shutil
+# third party imports
+import numpy as np
+# local imports
+from mgr_api.categorical import Categorical, CategoricalBuilder
+from mgr_api.util import native_str, replace
+
+FORMAT = 'mgr_api.table'
+VERSION = 1
+META_FILE = 'meta.json'
+KEYS_FILE = 'keys.npy'
+VALUES_FILE = 'values.npy'
+# how whole float abundances are written: '1' or '1.0'
+INTEGER_FORMAT = 'integer'
+REPR_FORMAT = 'repr'
+
+
+def format_value(number, float_format=INTEGER_FORMAT):
+    """
+    Format an abundance value as text. Integral values are written without a
+    decimal point, unless float_format is REPR_FORMAT, in which case all
+    values are written as repr(float) (e.g. '1.0').
+    """
+    number = float(number)
+    if float_format == INTEGER_FORMAT and number.is_integer():
+        return '%d' % number
+    return repr(number)
+
+
+def _numeric(cells):
+    """
+    Convert an array of abundance strings to an int64 array, or a float64
+    array if any value is not an integer. Empty cells are zero.
+
+    Also return the set of ways the integral values are written: True for
+    with a decimal point (e.g. '1.0'), False for without.
+    """
+    empty = cells == cells.dtype.type()
+    cells = cells.copy()
+    cells[empty] = '0'
+    try:
+        return cells.astype(np.int64), set([False])
+    except ValueError:
+        values = cells.astype(np.float64)
+    whole = ~empty & (values == np.floor(values))
+    return values, set((np.char.find(cells[whole], '.') >= 0).tolist())
+
+
+class AbundanceTable(object):
+    """
+    An abundance table with its key columns (e.g. the subsystem levels or a
+    function ID) stored as Categorical columns and its abundances as a 2D
+    NumPy array.
+
+    :type key_columns: list
+    :param key_columns: The names of the key columns.
+    :type keys: list
+    :param keys: A Categorical for each key column.
+    :type samples: list
+    :param samples: The sample (e.g. metagenome) IDs, one per values column.
+    :type values: numpy.ndarray
+    :param values: The abundances, with a row per table row and a column
+                   per sample.
+    :type float_format: str
+    :param float_format: How float abundances are written as text (see
+                         format_value()).
+    """
+    def __init__(self, key_columns, keys, samples, values,
+                 float_format=INTEGER_FORMAT):
+        self.key_columns = list(key_columns)
+        self.keys = keys
+        self.samples = list(samples)
+        self.values = values
+        self.float_format = float_format
+
+    @classmethod
+    def from_rows(cls, key_columns, samples, rows, chunk_size=10000):
+        """
+        Build a table from an iterable of (key, values) rows, where key is a
+        sequence of key column values and values a sequence of abundances,
+        as numbers or strings. Rows are converted chunk_size at a time.
+
+        If every whole float abundance given as a string is written with a
+        decimal point (e.g. '1.0'), the table writes them back that way.
+        """
+        builders = [CategoricalBuilder() for _ in key_columns]
+        chunks = []
+        point_styles = set()
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            cells = []
+            for key, values in chunk:
+                for builder, value in zip(builders, key):
+                    builder.append(value)
+                cells.append(values)
+            cells = np.array(cells)
+            if cells.dtype.kind in 'SU':
+                cells, styles = _numeric(cells)
+                point_styles |= styles
+            chunks.append(cells.reshape(len(chunk), len(samples)))
+
+        if chunks:
+            values = np.concatenate(chunks)
+        else:
+            values = np.empty((0, len(samples)), dtype=np.int64)
+        float_format = (REPR_FORMAT if point_styles == set([True])
+                        else INTEGER_FORMAT)
+        return cls(key_columns, [builder.build() for builder in builders],
+                   samples, values, float_format)
+
+    def __len__(self):
+        return len(self.values)
+
+    def key_column(self, name):
+        """
+        Return the decoded values of the named key column.
+        """
+        return self.keys[self.key_columns.index(name)].values()
+
+    def take(self, idx):
+        """
+        Return a new table of the rows selected by a boolean mask or an
+        array of row indices.
+        """
+        return AbundanceTable(self.key_columns,
+                              [key[idx] for key in self.keys],
+                              self.samples, self.values[idx],
+                              self.float_format)
+
+    def rows(self):
+        """
+        Iterate over the rows as lists of strings: the key column values
+        followed by the formatted abundances, as in the TSV format.
+        """
+        keys = [key.values() for key in self.keys]
+        fmt = (str if self.values.dtype.kind in 'iu'
+               else partial(format_value, float_format=self.float_format))
+        for i in range(len(self)):
+            yield ([key[i] for key in keys] +
+                   [fmt(value) for value in self.values[i].tolist()])
+
+
+def is_table(path):
+    """
+    Return True if path is a table written by write_table().
+    """
+    return osp.isfile(osp.join(path, META_FILE))
+
+
+def write_table(table, path):
+    """
+    Write an AbundanceTable to the directory path, replacing any table
+    already there. The table is written to a temporary directory first so
+    that readers never see a partial table.
+    """
+    path = osp.abspath(path)
+    tmp_path = path + '.tmp'
+    if osp.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    meta = {'format': FORMAT, 'version': VERSION,
+            'key_columns': table.key_columns, 'samples': table.samples,
+            'key_categories': [key.categories.tolist() for key in table.keys],
+            'float_format': table.float_format}
+    with open(osp.join(tmp_path, META_FILE), 'w') as meta_f:
+        json.dump(meta, meta_f)
+    key_codes = np.empty((len(table), len(table.keys)), dtype=np.int32)
+    for i, key in enumerate(table.keys):
+        key_codes[:, i] = key.codes
+    np.save(osp.join(tmp_path, KEYS_FILE), key_codes)
+    np.save(osp.join(tmp_path, VALUES_FILE), np.asarray(table.values))
+
+    if osp.isdir(path):
+        shutil.rmtree(path)
+    replace(tmp_path, path)
+
+
+def read_table(path, mmap=True):
+    """
+    Read a table written by write_table(). The key codes and abundances are
+    memory-mapped unless mmap is False.
+
+    :rtype: AbundanceTable
+    """
+    with open(osp.join(path, META_FILE)) as meta_f:
+        meta = json.load(meta_f)
+    if meta.get('format') != FORMAT or meta.get('version', 0) > VERSION:
+        raise ValueError("Unsupported table format in {}".format(path))
+
+    mmap_mode = 'r' if mmap else None
+    key_codes = np.load(osp.join(path, KEYS_FILE), mmap_mode=mmap_mode)
+    values = np.load(osp.join(path, VALUES_FILE), mmap_mode=mmap_mode)
+    keys = []
+    for i, categories in enumerate(meta['key_categories']):
+        category_array = np.empty(len(categories), dtype=object)
+        category_array[:] = [native_str(value) for value in categories]
+        keys.append(Categorical(key_codes[:, i], category_array))
+    return AbundanceTable([native_str(name) for name in meta['key_columns']],
+                          keys,
+                          [native_str(mg_id) for mg_id in meta['samples']],
+                          values, meta.get('float_format', INTEGER_FORMAT))
+
+
+def read_tsv(in_f, n_key_columns):
+    """
+    Parse a tab-separated abundance table whose first n_key_columns columns
+    are keys and whose remaining columns hold the abundance of each sample.
+
+    :type in_f: file or string
+    :param in_f: The open table, or its path.
+    :rtype: AbundanceTable
+    """
+    if not hasattr(in_f, 'read'):
+        with open(in_f) as tsv_f:
+            return read_tsv(tsv_f, n_key_columns)
+    reader = csv.reader(in_f, delimiter='\t')
+    header = next(reader)
+    n_samples = len(header) - n_key_columns
+    rows = ((row[:n_key_columns],
+             (row[n_key_columns:] + [''] * n_samples)[:n_samples])
+            for row in reader if row)
+    return AbundanceTable.from_rows(header[:n_key_columns],
+                                    header[n_key_columns:], rows)
+
+
+def write_tsv(table, out_f):
+    """
+    Write an AbundanceTable in the tab-separated format read by read_tsv().
+
+    :type out_f: file or string
+    :param out_f: The open output file, or its path.
+    """
+    if not hasattr(out_f, 'write'):
+        with open(out_f, 'w') as tsv_f:
+            return write_tsv(table, tsv_f)
+    out_f.write('\t'.join(table.key_columns + table.samples) + '\n')
+    for row in table.rows():
+        out_f.write('\t'.join(row) + '\n')
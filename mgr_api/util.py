@@ -0,0 +1,19 @@
+"""
+This module contains small helpers shared by the mgr_api modules and the
+bin/ tools.
+"""
+from __future__ import absolute_import, division, print_function
+
+# standard library imports
+import os
+
+# atomic rename over an existing file (os.replace is unavailable on Python 2)
+replace = getattr(os, 'replace', os.rename)
+
+
+def native_str(value):
+    """
+    Return a (JSON-decoded) string as the native str type: unicode strings
+    are UTF-8 encoded on Python 2, where the tools work with str.
+    """
+    return value.encode('utf-8') if not isinstance(value, str) else value
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import unittest
+
+import requests
+
+from mgr_api.api import MGRASTAuthenticationException
+from mgr_api import aio
+
+
+class Test_aio(unittest.TestCase):
+
+    class FakeClient(object):
+        def __init__(self):
+            self.calls = 0
+            self.params = []
+
+        def request(self, method, item_id=None, params=None, auth_key=None,
+                    debug=False):
+            self.calls += 1
+            self.params.append(params)
+            if item_id == 'bad':
+                raise MGRASTAuthenticationException('authentication failed')
+            resp = requests.Response()
+            resp._content = json.dumps({'data': [{'md5': item_id}]}).encode()
+            return resp
+
+    def test_md5(self):
+        client = aio.AsyncMGRASTClient(self.FakeClient(), max_concurrency=2)
+        result = asyncio.run(aio.gather(*[client.md5(c) for c in 'abc']))
+        self.assertEqual([r['data'][0]['md5'] for r in result],
+                         ['a', 'b', 'c'])
+
+    def test_auth_failure(self):
+        client = aio.AsyncMGRASTClient(self.FakeClient(), max_concurrency=1)
+        coros = [client.md5(c) for c in ['bad', 'x', 'y']]
+        self.assertRaises(MGRASTAuthenticationException, asyncio.run,
+                          aio.gather(*coros))
+
+    def test_annotation_params(self):
+        fake = self.FakeClient()
+        client = aio.AsyncMGRASTClient(fake)
+        params = {'evalue': 5}
+        asyncio.run(client._annotation('annotation/sequence', 'mgm1', 'KEGG',
+                                       'function', '', params))
+        self.assertEqual(params, {'evalue': 5})
+        self.assertEqual(fake.params, [{'evalue': 5, 'source': 'KEGG',
+                                        'type': 'function'}])
+
+ 
+ 
+if __name__ == '__main__':
+    unittest.main()
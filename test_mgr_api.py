@@ -1,8 +1,22 @@
+import io
 import json
+import os.path as osp
+import shutil
+import tempfile
 import unittest
 
+import numpy as np
+import requests
+
 from mgr_api.api import (MGRASTException, MGRASTAuthenticationException,
-                         mgrast_request, id_check)
+                         MGRASTClient, mgrast_request, id_check,
+                         map_concurrent, iter_annotation,
+                         iter_metagenome_data, download_metagenome_data)
+from mgr_api import api, m5nr, table
+from mgr_api.cache import ResponseCache, FOREVER
+from mgr_api.ratelimit import RateLimiter, RetryPolicy
+from mgr_api.similarity import SimilarityBatch
+from mgr_api.store import M5NRStore
 
  
 class Test_api(unittest.TestCase):
@@ -23,11 +37,319 @@ class Test_api(unittest.TestCase):
         except MGRASTAuthenticationException as me:
             self.assertIn( 'insufficient permissions', me.message)
     
+    def test_client_url(self):
+        client = MGRASTClient(base_url='http://example.org/1/')
+        self.assertEqual(client.url('metagenome', 'mgm4440026.3',
+                                    {'verbosity': 'minimal'}),
+                         'http://example.org/1/metagenome/mgm4440026.3'
+                         '?verbosity=minimal')
+        self.assertEqual(client.url('matrix/function',
+                                    params={'id': ['a', 'b']}),
+                         'http://example.org/1/matrix/function?id=a&id=b')
+
+    def test_map_concurrent_order(self):
+        self.assertEqual(map_concurrent(lambda x: x * 2, range(20), 4),
+                         [x * 2 for x in range(20)])
+
+    def test_map_concurrent_auth_failure(self):
+        def fetch(x):
+            if x == 3:
+                raise MGRASTAuthenticationException('authentication failed')
+            return x
+        self.assertRaises(MGRASTAuthenticationException,
+                          map_concurrent, fetch, range(10), 4)
+
+    def annotation_response(self, body):
+        resp = requests.Response()
+        resp._content = body
+        resp._content_consumed = True
+        resp.encoding = 'utf-8'
+        return resp
+
+    def test_iter_annotation(self):
+        resp = self.annotation_response(b'id\tmd5\nr1\ta\nr2\tb\n'
+                                        b'Download complete. 2 rows\n')
+        self.assertEqual(list(iter_annotation(resp, chunk_size=4)),
+                         [['r1', 'a'], ['r2', 'b']])
+
+    def test_iter_annotation_no_charset(self):
+        resp = requests.Response()
+        resp.raw = io.BytesIO(b'id\tmd5\nr1\ta\nDownload complete. 1 rows\n')
+        self.assertEqual(list(iter_annotation(resp)), [['r1', 'a']])
+
+    def test_iter_annotation_truncated(self):
+        resp = self.annotation_response(b'id\tmd5\nr1\ta\nr2\tb')
+        self.assertRaises(MGRASTException, list, iter_annotation(resp))
+
+    def test_download_metagenome_data(self):
+        def fetch(mg, database, dtype, auth_key, **params):
+            if mg == 'mgm2':
+                raise MGRASTException('not found')
+            return [[mg, database, params['evalue']]]
+        errors = {}
+        rows = download_metagenome_data(['mgm1', 'mgm2', 'mgm3'], fetch,
+                                        params={'evalue': 5}, max_workers=3,
+                                        errors=errors)
+        self.assertEqual(rows, [['mgm1', 'KEGG', 5], ['mgm3', 'KEGG', 5]])
+        self.assertEqual(list(errors), ['mgm2'])
+        self.assertRaises(MGRASTException, download_metagenome_data,
+                          ['mgm1', 'mgm2'], fetch, params={'evalue': 5})
+
+    def test_iter_metagenome_data_unordered(self):
+        fetch = lambda mg, database, dtype, auth_key: [mg]
+        results = iter_metagenome_data(['a', 'b', 'c'], fetch, ordered=False)
+        self.assertEqual(sorted(results),
+                         [('a', ['a']), ('b', ['b']), ('c', ['c'])])
+
+    def test_sequential_without_futures(self):
+        executor, api.ThreadPoolExecutor = api.ThreadPoolExecutor, None
+        try:
+            self.test_map_concurrent_order()
+            self.test_map_concurrent_auth_failure()
+            self.test_download_metagenome_data()
+        finally:
+            api.ThreadPoolExecutor = executor
+
     def test_id_check_missing(self):
         self.assertEqual(id_check('mgp','1234'), 'mgp1234')
         
     def test_id_check_present(self):
         self.assertEqual(id_check('mgp','mgp1234'), 'mgp1234')
+
+class Test_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.cache_dir, max_bytes=10)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.cache_dir)
+
+    def response(self, body):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers['content-type'] = 'text/plain'
+        resp._content = body
+        return resp
+
+    def test_key_auth_identity(self):
+        k1 = self.cache.key('project', 'mgp1', {'verbosity': 'full'}, 'a')
+        k2 = self.cache.key('project', 'mgp1', {'verbosity': 'full'}, 'b')
+        self.assertNotEqual(k1, k2)
+        self.assertEqual(k1, self.cache.key('project', 'mgp1',
+                                            {'verbosity': ['full']}, 'a'))
+
+    def test_ttl(self):
+        self.assertIs(self.cache.ttl('download', {'file': '050.1'}), FOREVER)
+        self.assertEqual(self.cache.ttl('download', {'stage': '050'}),
+                         self.cache.ttls['download'])
+        self.assertEqual(self.cache.ttl('m5nr/ontology'),
+                         self.cache.ttls['m5nr'])
+
+    def test_hit_miss_evict(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 'download', self.response(b'123456'))
+        self.assertEqual(self.cache.get('a').text, '123456')
+        self.cache.set('b', 'download', self.response(b'789012'))
+        self.assertIsNone(self.cache.get('a'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (1, 2, 1))
+
+
+class Test_similarity(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [['r1', 'aa', '99.5', '100', '0', '0', '1', '100', '1',
+                      '100', '1e-50', '200.5', 'K00001'],
+                     ['r1', 'bb', '60.0', '40', '10', '1', '1', '40', '1',
+                      '40', '1e-3', '30.0', 'K00002'],
+                     ['r2', 'aa', '80.0', '90', '5', '0', '1', '90', '1',
+                      '90', '1e-20', '120.0', 'K00001']]
+        self.batch = SimilarityBatch.from_rows(iter(self.rows))
+
+    def test_columns(self):
+        self.assertEqual(len(self.batch), 3)
+        self.assertEqual(list(self.batch.md5.codes), [0, 1, 0])
+        self.assertEqual(list(self.batch['length']), [100, 40, 90])
+        self.assertEqual(self.batch['evalue'][0], 1e-50)
+
+    def test_filter(self):
+        hits = self.batch.filter(max_evalue=1e-10, min_identity=90)
+        self.assertEqual(list(hits.query_id.values()), ['r1'])
+        hits = self.batch.filter(min_length=50)
+        self.assertEqual(list(hits.md5.values()), ['aa', 'aa'])
+        self.assertEqual([r[0] for r in hits.rows()], ['r1', 'r2'])
+
+
+class Test_ratelimit(unittest.TestCase):
+
+    class FakeSession(object):
+        def __init__(self, statuses):
+            self.statuses = list(statuses)
+            self.calls = 0
+
+        def request(self, verb, url, headers=None, data=None, stream=False,
+                    timeout=None):
+            self.calls += 1
+            status = self.statuses.pop(0)
+            if status is None:
+                raise requests.ConnectionError('connection reset')
+            resp = requests.Response()
+            resp.status_code = status
+            resp.headers['content-type'] = 'text/plain'
+            resp._content = b''
+            resp.raw = io.BytesIO()
+            return resp
+
+    def client(self, statuses, retries=2, connection_errors=True):
+        retry = RetryPolicy(retries, backoff=0,
+                            connection_errors=connection_errors)
+        client = MGRASTClient(retry=retry, rate_limiter=RateLimiter(rate=1000))
+        client.session = self.FakeSession(statuses)
+        return client
+
+    def test_adaptive_rate(self):
+        limiter = RateLimiter(rate=8, min_rate=1)
+        limiter.failure()
+        limiter.failure()
+        self.assertEqual(limiter.rate, 2)
+        limiter.success()
+        self.assertAlmostEqual(limiter.rate, 2.1)
+        for _ in range(4):
+            limiter.failure()
+        self.assertEqual(limiter.rate, 1)
+
+    def test_retry_transient(self):
+        client = self.client([503, None, 200])
+        self.assertEqual(client.request('project', 'mgp1').status_code, 200)
+        self.assertEqual(client.session.calls, 3)
+        self.assertLess(client.rate_limiter.rate, 1000)
+
+    def test_retry_exhausted(self):
+        client = self.client([None, None, None])
+        self.assertRaises(requests.ConnectionError, client.request, 'project')
+        client = self.client([500, 500, 500, 200])
+        self.assertEqual(client.request('project').status_code, 500)
+
+    def test_connection_error_fails_fast(self):
+        client = self.client([None, 200], connection_errors=False)
+        self.assertRaises(requests.ConnectionError, client.request, 'project')
+        self.assertEqual(client.session.calls, 1)
+        self.assertIsNone(MGRASTClient().rate_limiter)
+
+
+class Test_m5nr(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.request = api.mgrast_request
+        api.mgrast_request = self.fake_request
+
+    def tearDown(self):
+        api.mgrast_request = self.request
+
+    def fake_request(self, method, item_id=None, params=None, auth_key=None,
+                     debug=False, stream=False, headers=None, data=None):
+        self.calls.append(data)
+        # two entries per md5, served in pages of data['limit']
+        entries = [{'md5': md5, 'source': src}
+                   for md5 in data['data'] for src in ('KO', 'SEED')]
+        page = entries[data['offset']:data['offset'] + data['limit']]
+        resp = requests.Response()
+        resp._content = json.dumps({'data': page,
+                                    'total_count': len(entries)}).encode()
+        return resp
+
+    def test_md5_bulk(self):
+        result = m5nr.md5_bulk(['a', 'b', 'a', 'c'], batch_size=2,
+                               max_workers=2, limit=3, source='KO')
+        self.assertEqual(list(result), ['a', 'b', 'c'])
+        self.assertEqual([e['source'] for e in result['b']], ['KO', 'SEED'])
+        self.assertEqual(len(self.calls), 3)
+        self.assertTrue(all(c['source'] == 'KO' for c in self.calls))
+
+
+class Test_store(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = M5NRStore(osp.join(self.tmp_dir, 'm5nr.sqlite'))
+        self.store.add_ontology({'K00001': {'accession': 'K00001',
+                                            'level1': 'Metabolism',
+                                            'level4': 'adh'},
+                                 'K00002': {'accession': 'K00002',
+                                            'level1': 'Metabolism',
+                                            'level4': 'akr'}}, 'KO')
+        self.store.add_md5({'aa': [{'md5': 'aa', 'accession': 'K00002',
+                                    'source': 'KO'}],
+                            'bb': []})
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookups(self):
+        self.assertEqual(self.store.ontology('K00001')['level4'], 'adh')
+        self.assertIsNone(self.store.ontology('K99999'))
+        self.assertEqual(len(self.store.by_level(1, 'Metabolism')), 2)
+        self.assertEqual(self.store.md5('aa')[0]['accession'], 'K00002')
+        self.assertEqual(self.store.md5('bb'), [])
+        self.assertIsNone(self.store.md5('cc'))
+        self.assertEqual([e['level4'] for e in self.store.md5_ontology('aa')],
+                         ['akr'])
+
+
+class Test_table(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tsv = ('Level 1\tID\tmgm1\tmgm2\n'
+                    'Metabolism\tK00001\t3\t0\n'
+                    'Metabolism\tK00002\t\t7\n'
+                    'Genetic\tK00003\t1\t2\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_tsv(self):
+        abd = table.read_tsv(io.StringIO(self.tsv), 2)
+        self.assertEqual(abd.key_columns, ['Level 1', 'ID'])
+        self.assertEqual(abd.samples, ['mgm1', 'mgm2'])
+        self.assertEqual(list(abd.keys[0].codes), [0, 0, 1])
+        self.assertEqual(abd.values.tolist(), [[3, 0], [0, 7], [1, 2]])
+
+    def test_round_trip(self):
+        path = osp.join(self.tmp_dir, 'abd')
+        table.write_table(table.read_tsv(io.StringIO(self.tsv), 2), path)
+        self.assertTrue(table.is_table(path))
+        abd = table.read_table(path)
+        self.assertEqual(list(abd.key_column('ID')),
+                         ['K00001', 'K00002', 'K00003'])
+        out_f = io.StringIO()
+        table.write_tsv(abd.take(abd.values[:, 1] > 0), out_f)
+        self.assertEqual(out_f.getvalue(), 'Level 1\tID\tmgm1\tmgm2\n'
+                                           'Metabolism\tK00002\t0\t7\n'
+                                           'Genetic\tK00003\t1\t2\n')
+
+    def test_float_values(self):
+        abd = table.read_tsv(io.StringIO('ID\tmgm1\nK1\t0.5\nK2\t2\n'), 1)
+        self.assertEqual(abd.values.dtype, np.float64)
+        self.assertEqual([row[1] for row in abd.rows()], ['0.5', '2'])
+
+    def test_float_format(self):
+        path = osp.join(self.tmp_dir, 'abd')
+        tsv = 'ID\tmgm1\tmgm2\nK1\t0.0\t1.5\nK2\t2.0\t\n'
+        abd = table.read_tsv(io.StringIO(tsv), 1)
+        self.assertEqual(abd.float_format, table.REPR_FORMAT)
+        table.write_table(abd, path)
+        out_f = io.StringIO()
+        table.write_tsv(table.read_table(path), out_f)
+        self.assertEqual(out_f.getvalue(),
+                         'ID\tmgm1\tmgm2\nK1\t0.0\t1.5\nK2\t2.0\t0.0\n')
+        abd = table.read_tsv(io.StringIO('ID\tmgm1\nK1\t0.0\nK2\t1\n'), 1)
+        self.assertEqual(abd.float_format, table.INTEGER_FORMAT)
  
  
 if __name__ == '__main__':